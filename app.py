@@ -1,3 +1,4 @@
+import asyncio
 import os
 import sys
 from pathlib import Path
@@ -11,8 +12,10 @@ from rich import box
 from rich.text import Text
 from rich.style import Style
 
-from processor import process_file, process_directory, process_url
-from extractor import extract_text, is_url
+from processor import report_metrics
+from ingest import Ingestor
+from archives import outer_path
+from query_index import filter_files, is_tag_expression
 from database import (
     create_tables,
     add_file_to_db,
@@ -26,9 +29,9 @@ from database import (
     get_file_by_id,
     update_file_tags,
     list_files,
-    get_tags_for_file,
+    compute_facets,
 )
-from config import colors
+from config import colors, server_host, server_port
 
 
 def main():
@@ -46,12 +49,30 @@ def main():
     add_parser.add_argument(
         "input_path", type=str, help="Relative or absolute path to the file or URL"
     )
+    add_parser.add_argument(
+        "--triage",
+        action="store_true",
+        help="Store quick provisional metadata first, then refine it",
+    )
+
+    # Refine
+    subparsers.add_parser(
+        "refine", help="Replace provisional metadata with a full analysis"
+    )
 
     # Search
     search_parser = subparsers.add_parser(
         "search", aliases=["s"], help="Search files by keywords"
     )
     search_parser.add_argument("keywords", type=str, help="Keywords to search")
+    search_parser.add_argument(
+        "--facets",
+        action="store_true",
+        help="Also show top tags, file types and months among the results",
+    )
+    search_parser.add_argument(
+        "--limit", type=int, help="Show at most this many files, lowest IDs first"
+    )
     search_parser.add_argument(
         "--format",
         choices=["table", "json", "csv"],
@@ -67,7 +88,25 @@ def main():
         "tags",
         nargs="?",
         default="",
-        help="Comma-separated list of tags (default: empty)",
+        help="Comma-separated list of tags, or an expression such as "
+        "'a AND (b OR NOT c)' (default: empty)",
+    )
+    filter_parser.add_argument(
+        "--type", type=str, help="Comma-separated list of file types"
+    )
+    filter_parser.add_argument(
+        "--facets",
+        action="store_true",
+        help="Also show top tags, file types and months among the results",
+    )
+    filter_parser.add_argument(
+        "--date-after", type=str, help="Files created after this date (YYYY-MM-DD)"
+    )
+    filter_parser.add_argument(
+        "--date-before", type=str, help="Files created before this date (YYYY-MM-DD)"
+    )
+    filter_parser.add_argument(
+        "--limit", type=int, help="Show at most this many files, lowest IDs first"
     )
     filter_parser.add_argument(
         "--format",
@@ -81,6 +120,9 @@ def main():
     list_parser.add_argument(
         "--date-after", type=str, help="List files created after this date (YYYY-MM-DD)"
     )
+    list_parser.add_argument(
+        "--limit", type=int, help="Show at most this many files, lowest IDs first"
+    )
     list_parser.add_argument(
         "--format",
         choices=["table", "json", "csv"],
@@ -121,35 +163,61 @@ def main():
     open_parser = subparsers.add_parser("open", aliases=["o"], help="Open a file")
     open_parser.add_argument("file_id", type=int, help="File ID to open")
 
+    # Benchmark extractors
+    bench_parser = subparsers.add_parser(
+        "bench", help="Benchmark extractor backends on sample files"
+    )
+    bench_parser.add_argument(
+        "paths", nargs="+", help="Files or directories to use as samples"
+    )
+
+    # Serve
+    serve_parser = subparsers.add_parser(
+        "serve", help="Serve queries over a local HTTP/JSON API"
+    )
+    serve_parser.add_argument(
+        "--host", type=str, default=server_host, help=f"Host (default: {server_host})"
+    )
+    serve_parser.add_argument(
+        "--port", type=int, default=server_port, help=f"Port (default: {server_port})"
+    )
+    serve_parser.add_argument(
+        "--socket", type=str, help="Listen on a Unix socket instead of TCP"
+    )
+
     args = parser.parse_args()
 
     try:
         if args.command in ["add", "a"]:
-            if is_url(args.input_path):
-                process_url(args.input_path)
-            else:
-                path = os.path.abspath(args.input_path)
-                if os.path.isfile(path):
-                    process_file(path)
-                elif os.path.isdir(path):
-                    process_directory(path)
-                else:
-                    raise ValueError(
-                        f"The input path {path} is neither a file nor a directory."
-                    )
+            asyncio.run(run_ingest(args.input_path, args.triage))
+            report_metrics()
             print("Processing completed successfully.")
 
+        elif args.command == "refine":
+            asyncio.run(run_refine())
+            report_metrics()
+
         elif args.command in ["search", "s"]:
-            results = search_files(args.keywords)
-            output_results(results, args.format)
+            # Facets count every match, so the limit is applied after them
+            fetch_limit = None if args.facets else args.limit
+            results = search_files(args.keywords, fetch_limit)
+            output_results(results, args.format, args.facets, args.limit)
 
         elif args.command in ["filter", "f"]:
-            tags = args.tags.split(",") if args.tags else []
-            results = filter_by_tags(tags)
-            output_results(results, args.format)
+            fetch_limit = None if args.facets else args.limit
+            ranged = args.type or args.date_after or args.date_before
+            if is_tag_expression(args.tags) or ranged:
+                file_types = args.type.split(",") if args.type else None
+                results = filter_files(
+                    args.tags, file_types, args.date_after, args.date_before, fetch_limit
+                )
+            else:
+                tags = args.tags.split(",") if args.tags else []
+                results = filter_by_tags(tags, fetch_limit)
+            output_results(results, args.format, args.facets, args.limit)
 
         elif args.command in ["list", "l", "ls"]:
-            results = list_files(args.date_after)
+            results = list_files(args.date_after, args.limit)
             output_results(results, args.format)
 
         elif args.command in ["stats", "st"]:
@@ -180,21 +248,81 @@ def main():
         elif args.command in ["open", "o"]:
             file_info = get_file_by_id(args.file_id)
             if file_info:
-                os.system(f"xdg-open '{file_info['path']}'")
+                # Archive members open their containing archive
+                os.system(f"xdg-open '{outer_path(file_info['path'])}'")
             else:
                 print(f"No file found with ID {args.file_id}")
 
+        elif args.command == "bench":
+            from benchmark import benchmark_extractors, save_benchmarks
+
+            results = benchmark_extractors(args.paths)
+            save_benchmarks(results)
+            output_benchmarks(results)
+
+        elif args.command == "serve":
+            from server import serve
+
+            serve(args.host, args.port, args.socket)
+
     except Exception as e:
         print(f"An error occurred: {e}")
 
 
-def output_results(results, format):
+async def run_ingest(input_path, triage):
+    async with Ingestor() as ingestor:
+        async for result in ingestor.iter_ingest(input_path, triage):
+            output_ingest_result(result)
+        # Report what the pre-flight scan filtered out
+        if ingestor.skipped:
+            print(f"Skipped {sum(ingestor.skipped.values())} entries:")
+            for reason, count in ingestor.skipped.most_common():
+                print(f"  {reason}: {count}")
+
+
+async def run_refine():
+    async with Ingestor() as ingestor:
+        async for result in ingestor.iter_refine():
+            output_ingest_result(result)
+
+
+def output_ingest_result(result):
+    extraction = result.extraction
+    if extraction is not None and extraction.status == "garbage":
+        print(f"Text of {result.path} looks unreadable ({extraction.garbage_score:.0%} garbage)")
+    if result.status == "added":
+        print(f"\n{result.meta}\n")
+        print(f"Metadata for {result.path} has been successfully added to database.")
+    elif result.status == "refined":
+        print(f"Refined metadata for {result.path}.")
+    elif result.status == "skipped":
+        print(f"Could not extract text from {result.path}: {result.error}")
+    else:
+        print(f"An error occurred while processing {result.path}: {result.error}")
+
+
+def output_results(results, format, facets=False, limit=None):
+    facet_counts = compute_facets(results) if facets else None
+    results = results[:limit]
     if format == "json":
-        print(json.dumps(results, indent=2))
+        if facets:
+            print(json.dumps({"results": results, "facets": facet_counts}, indent=2))
+        else:
+            print(json.dumps(results, indent=2))
     elif format == "csv":
         writer = csv.DictWriter(sys.stdout, fieldnames=results[0].keys())
         writer.writeheader()
-        writer.writerows(results)
+        writer.writerows(
+            dict(result, tags=", ".join(result["tags"])) for result in results
+        )
+        if facets:
+            print()
+            facet_writer = csv.writer(sys.stdout)
+            facet_writer.writerow(["facet", "value", "count"])
+            for facet, counts in facet_counts.items():
+                facet_writer.writerows(
+                    [facet, value, count] for value, count in counts.items()
+                )
     else:  # table format
         console = Console()
         table = Table(
@@ -216,7 +344,7 @@ def output_results(results, format):
                 )
 
             for result in results:
-                tags = ", ".join(get_tags_for_file(result["id"]))
+                tags = ", ".join(result["tags"])
                 row = [
                     Text(str(result["id"]), style=colors["id"]),
                     Text(result["title"], overflow="fold", style=colors["title"]),
@@ -228,6 +356,19 @@ def output_results(results, format):
                 table.add_row(*row)
 
         console.print(table)
+        if facets:
+            output_facets(facet_counts)
+
+
+def output_facets(facet_counts):
+    console = Console()
+    for facet, counts in facet_counts.items():
+        table = Table(show_header=True, header_style="bold magenta")
+        table.add_column(facet.replace("_", " ").title(), style="dim", justify="right")
+        table.add_column("Count", justify="right")
+        for value, count in counts.items():
+            table.add_row(str(value), str(count))
+        console.print(table)
 
 
 def output_stats(stats):
@@ -242,5 +383,29 @@ def output_stats(stats):
     console.print(table)
 
 
+def output_benchmarks(results):
+    console = Console()
+    table = Table(show_header=True, header_style="bold magenta")
+    table.add_column("Format")
+    table.add_column("Backend")
+    table.add_column("Files", justify="right")
+    table.add_column("Errors", justify="right")
+    table.add_column("MB/s", justify="right")
+    table.add_column("Pages/s", justify="right")
+
+    for ext, backends in results.items():
+        for name, stats in backends.items():
+            table.add_row(
+                ext,
+                name,
+                str(stats["files"]),
+                str(stats["errors"]),
+                f"{stats['mb_per_sec']:.2f}",
+                f"{stats['pages_per_sec']:.1f}",
+            )
+
+    console.print(table)
+
+
 if __name__ == "__main__":
     main()
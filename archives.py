@@ -0,0 +1,211 @@
+import io
+import mimetypes
+import os
+import tarfile
+import zipfile
+from collections import Counter
+from typing import IO, Iterator, Tuple
+
+from config import (
+    archive_max_depth,
+    archive_max_members,
+    archive_max_size,
+    archive_max_ratio,
+)
+from extractor import read_email
+import scanner
+
+ARCHIVE_SUFFIXES = (
+    ".zip",
+    ".tar",
+    ".tar.gz",
+    ".tgz",
+    ".tar.bz2",
+    ".tbz2",
+    ".tar.xz",
+    ".txz",
+)
+EMAIL_SUFFIXES = (".eml",)
+# Separates an archive path from the path of a member inside it
+MEMBER_SEPARATOR = "!/"
+
+
+class ArchiveLimitError(Exception):
+    pass
+
+
+def is_archive(path: str) -> bool:
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def is_container(path: str) -> bool:
+    return is_archive(path) or path.lower().endswith(EMAIL_SUFFIXES)
+
+
+def outer_path(path: str) -> str:
+    """Return the real file a (possibly virtual) member path lives in."""
+    return path.split(MEMBER_SEPARATOR, 1)[0]
+
+
+class Budget:
+    """Uncompressed bytes and members allowed for one top-level archive."""
+
+    def __init__(self):
+        self.members = 0
+        self.size = 0
+
+    def add_member(self, name: str, size: int):
+        self.members += 1
+        self.size += size
+        if self.members > archive_max_members:
+            raise ArchiveLimitError(f"more than {archive_max_members} members")
+        if self.size > archive_max_size:
+            raise ArchiveLimitError(f"more than {archive_max_size} bytes unpacked")
+
+
+class MemberStream(io.RawIOBase):
+    """Seekable view of an archive member that refuses to read past its size."""
+
+    def __init__(self, raw: IO[bytes], size: int):
+        self.raw = raw
+        self.size = size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self.raw.seekable()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.raw.seek(offset, whence)
+
+    def tell(self):
+        return self.raw.tell()
+
+    def readinto(self, buffer):
+        data = self.raw.read(len(buffer))
+        if self.raw.tell() > self.size:
+            raise ArchiveLimitError("member is larger than declared")
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def _stream_size(source: str | IO[bytes]) -> int:
+    if isinstance(source, str):
+        return os.path.getsize(source)
+    position = source.tell()
+    size = source.seek(0, io.SEEK_END)
+    source.seek(position)
+    return size
+
+
+def _too_compressed(size: int, compressed: int) -> bool:
+    return size > archive_max_ratio * max(compressed, 1)
+
+
+def _count_skipped(skipped: Counter | None, reason: str):
+    if skipped is not None:
+        skipped[reason] += 1
+
+
+def _iter_zip(source, budget: Budget, skipped: Counter | None):
+    with zipfile.ZipFile(source) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            # One suspicious member is skipped; the budget still covers the whole archive
+            if _too_compressed(info.file_size, info.compress_size):
+                _count_skipped(skipped, "compression ratio too high")
+                continue
+            budget.add_member(info.filename, info.file_size)
+            with zf.open(info) as member:
+                yield info.filename, member, info.file_size
+
+
+def _iter_tar(source, budget: Budget, skipped: Counter | None):
+    compressed = _stream_size(source)
+    unpacked = 0
+    if isinstance(source, str):
+        tar = tarfile.open(source, "r:*")
+    else:
+        tar = tarfile.open(fileobj=source, mode="r:*")
+    with tar:
+        for info in tar:
+            if not info.isfile():
+                continue
+            # Tar members are stored raw, so the ratio applies to the whole stream
+            if _too_compressed(unpacked + info.size, compressed):
+                _count_skipped(skipped, "compression ratio too high")
+                continue
+            budget.add_member(info.name, info.size)
+            unpacked += info.size
+            member = tar.extractfile(info)
+            if member is not None:
+                with member:
+                    yield info.name, member, info.size
+
+
+def _iter_attachments(source, budget: Budget):
+    msg = read_email(source)
+    for index, part in enumerate(msg.iter_attachments()):
+        name = part.get_filename()
+        if not name:
+            ext = mimetypes.guess_extension(part.get_content_type()) or ""
+            name = f"part-{index}{ext}"
+        payload = part.get_payload(decode=True)
+        if payload is None:
+            # Attached messages (message/rfc822) carry a parsed message instead
+            payload = part.get_content().as_bytes()
+            name = name if name.endswith(EMAIL_SUFFIXES) else f"{name}.eml"
+        budget.add_member(name, len(payload))
+        yield name, io.BytesIO(payload), len(payload)
+
+
+def iter_documents(
+    path: str,
+    source: IO[bytes] | None = None,
+    budget: Budget | None = None,
+    depth: int = 0,
+    skipped: Counter | None = None,
+) -> Iterator[Tuple[str, IO[bytes] | None]]:
+    """Yield (virtual path, stream) for every indexable document in `path`.
+
+    Plain files yield themselves with no stream. Archives yield their
+    members and emails yield themselves followed by their attachments.
+    Nested containers are traversed down to archive_max_depth. Members are
+    checked like scanned files, and members that are skipped, including
+    ones nested too deep or compressed too well, are counted in `skipped`.
+    Exceeding the member count or unpacked size of the top-level archive
+    raises ArchiveLimitError.
+    """
+    if not is_container(path):
+        yield path, source
+        return
+    if budget is None:
+        budget = Budget()
+
+    origin = path if source is None else source
+    if path.lower().endswith(".zip"):
+        members = _iter_zip(origin, budget, skipped)
+    elif is_archive(path):
+        members = _iter_tar(origin, budget, skipped)
+    else:
+        yield path, source
+        if source is not None:
+            source.seek(0)
+        members = _iter_attachments(origin, budget)
+
+    for name, member, size in members:
+        if is_container(name) and depth + 1 > archive_max_depth:
+            _count_skipped(skipped, "nested too deep")
+            continue
+        stream = io.BufferedReader(MemberStream(member, size))
+        reason = scanner.check_member(
+            name, size, lambda: stream.peek(scanner.SNIFF_SIZE)[: scanner.SNIFF_SIZE]
+        )
+        if reason is not None:
+            _count_skipped(skipped, reason)
+            continue
+        yield from iter_documents(
+            f"{path}{MEMBER_SEPARATOR}{name}", stream, budget, depth + 1, skipped
+        )
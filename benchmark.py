@@ -0,0 +1,79 @@
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+from config import benchmark_file
+from extractor import BACKENDS, select_backends
+from scanner import scan_directory
+
+# Characters per "standard page", used where the format has no page count
+PAGE_CHARS = 1800
+
+
+def count_pages(file_path: str, text: str) -> float:
+    if file_path.lower().endswith(".pdf"):
+        try:
+            from PyPDF2 import PdfReader
+
+            return len(PdfReader(file_path).pages)
+        except Exception:
+            pass
+    return len(text) / PAGE_CHARS
+
+
+def collect_files(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(scan_directory(path, Counter()))
+        elif os.path.isfile(path):
+            files.append(path)
+    return files
+
+
+def benchmark_extractors(paths: List[str]) -> Dict:
+    """Time every registered backend on the given files, grouped by extension."""
+    samples = defaultdict(list)
+    for file_path in collect_files(paths):
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext in BACKENDS:
+            samples[ext].append(file_path)
+
+    results = {}
+    for ext, files in samples.items():
+        results[ext] = {}
+        for name, extractor in BACKENDS[ext].items():
+            size = pages = elapsed = 0.0
+            errors = 0
+            for file_path in files:
+                start = time.perf_counter()
+                try:
+                    text = extractor(file_path)
+                except Exception:
+                    errors += 1
+                    continue
+                elapsed += time.perf_counter() - start
+                size += os.path.getsize(file_path)
+                pages += count_pages(file_path, text or "")
+            results[ext][name] = {
+                "files": len(files),
+                "errors": errors,
+                "mb_per_sec": size / 1024 / 1024 / elapsed if elapsed else 0.0,
+                "pages_per_sec": pages / elapsed if elapsed else 0.0,
+            }
+    return results
+
+
+def save_benchmarks(results: Dict):
+    # Merge with earlier runs so formats not sampled this time keep their numbers
+    try:
+        with open(benchmark_file, "r", encoding="utf-8") as file:
+            saved = json.load(file)
+    except (OSError, ValueError):
+        saved = {}
+    saved.update(results)
+    with open(benchmark_file, "w", encoding="utf-8") as file:
+        json.dump(saved, file, indent=2)
+    select_backends()
@@ -1,8 +1,36 @@
 ollama_host = 'http://localhost:11434'
 model_name = 'gemma2'
+ollama_backends = [  # optional pool of Ollama servers, overrides ollama_host when set
+    # {'host': 'http://gpu1:11434', 'model': 'gemma2', 'max_concurrency': 2},
+]
+health_check_interval = 30  # seconds before a failed backend is probed again
 temperature_value = 0.12
 attempts_number = 3
+schedule_order = ['pinned', 'recent', 'small']  # how `un add` orders a directory
+pinned_directories = []  # processed before everything else, in this order
+triage_model = ''  # small model for `un add --triage`, empty for heuristics only
+triage_max_chars = 4000  # text sent to the triage model
+structured_output = True  # constrain output to the JSON schema (Ollama 0.5+), False for plain JSON mode
 language = 'ru'
+ignore_patterns = [
+    '.git/', '.hg/', '.svn/', 'node_modules/', '__pycache__/', '.venv/', 'venv/',
+    '.DS_Store', '*.pyc', '*.o', '*.so', '*.dll', '*.exe', '*.class',
+]
+max_file_size = 50 * 1024 * 1024  # bytes, 0 disables the limit
+max_text_chars = 1_000_000  # text kept from one plain text or FB2 document, 0 for no limit
+data_sample_rows = 20  # rows/items sampled from large CSV, JSON and YAML files
+max_garbage_score = 0.2  # share of unreadable characters above which text is not sent to the model
+archive_max_depth = 3  # nested archives/emails traversed by `un add`
+archive_max_members = 10000
+archive_max_size = 1024 * 1024 * 1024  # unpacked bytes per top-level archive
+archive_max_ratio = 100  # unpacked/compressed size above which a member is skipped
+benchmark_file = 'extractor_benchmarks.json'  # written by `un bench`, used to pick backends
+server_host = '127.0.0.1'
+server_port = 8765
+server_cache_size = 256  # recent query results kept in memory by `un serve`
+query_index_file = 'files.db.index'  # in-memory tag index snapshot, empty disables it
+shard_count = 1  # databases the library is split into: files.db, files.1.db, ...
+shard_roots = []  # source directories pinned to shards 0, 1, ...; other paths are hashed
 colors = {
     "header_text": "#cad3f5",
     "border": "#b7bdf8",
@@ -0,0 +1,340 @@
+import json
+import math
+import random
+import re
+from collections import Counter
+from itertools import chain
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+
+from config import data_sample_rows
+
+# Data whose text fits in this many characters is passed on verbatim
+FULL_TEXT_CHARS = 20000
+# Rows sampled to infer column types and pick examples
+PROFILE_ROWS = 1000
+MAX_FIELDS = 100
+EXAMPLES_PER_FIELD = 3
+EXAMPLE_CHARS = 40
+SAMPLE_CHARS = 500
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2})?)?")
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class Reservoir:
+    """Uniform sample of a stream of unknown length, kept in stream order.
+
+    Uses Li's Algorithm L, which draws how many items to skip instead of
+    a random number per item.
+    """
+
+    def __init__(self, size: int, seed: int = 0):
+        self.size = size
+        self.seen = 0
+        self.items = []
+        self.random = random.Random(seed)
+        self.weight = self._draw_weight()
+        self.next = size + self._draw_skip()
+
+    def _draw_weight(self) -> float:
+        return math.exp(math.log(self.random.random() or 1e-300) / self.size)
+
+    def _draw_skip(self) -> int:
+        if self.weight >= 1:
+            return 1
+        return int(math.log(self.random.random() or 1e-300) / math.log(1 - self.weight)) + 1
+
+    def add(self, item):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append((self.seen, item))
+            return
+        if self.seen < self.next:
+            return
+        self.items[self.random.randrange(self.size)] = (self.seen, item)
+        self.weight *= self._draw_weight()
+        self.next += self._draw_skip()
+
+    def sample(self, size: int | None = None) -> List:
+        items = [item for _, item in sorted(self.items, key=lambda pair: pair[0])]
+        if size is None or len(items) <= size:
+            return items
+        # Evenly spaced picks of a uniform sample are still uniform
+        return [items[i * len(items) // size] for i in range(size)]
+
+
+def value_type(value) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "integer"
+    if isinstance(value, float):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, dict):
+        return "object"
+    if isinstance(value, list):
+        return "array"
+    return type(value).__name__
+
+
+def cell_type(value: str) -> str:
+    value = value.strip()
+    if not value:
+        return "empty"
+    if value.lower() in ("true", "false"):
+        return "boolean"
+    for kind, parse in (("integer", int), ("number", float)):
+        try:
+            parse(value)
+            return kind
+        except ValueError:
+            pass
+    if DATE_PATTERN.fullmatch(value):
+        return "date"
+    return "string"
+
+
+def compact(value) -> str:
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def fits(value, budget: int) -> bool:
+    """Tell whether a value serializes to roughly `budget` characters or less."""
+
+    def remaining(value, budget):
+        if isinstance(value, dict):
+            for key, member in value.items():
+                budget = remaining(member, budget - len(str(key)) - 4)
+                if budget < 0:
+                    break
+            return budget
+        if isinstance(value, list):
+            for member in value:
+                budget = remaining(member, budget - 2)
+                if budget < 0:
+                    break
+            return budget
+        return budget - len(str(value)) - 2
+
+    return remaining(value, budget) >= 0
+
+
+class Profile:
+    """Field names, types and example values seen over a stream of records."""
+
+    def __init__(self, typer: Callable[[Any], str] = value_type):
+        self.typer = typer
+        self.records = 0
+        self.types = {}
+        self.examples = {}
+
+    def _fields(self, record, prefix=""):
+        if not isinstance(record, dict):
+            yield prefix or "(value)", record
+            return
+        for key, value in record.items():
+            name = f"{prefix}{key}"
+            # One level of nesting is described field by field
+            if isinstance(value, dict) and not prefix:
+                yield from self._fields(value, f"{name}.")
+            else:
+                yield name, value
+
+    def add(self, record):
+        self.records += 1
+        for name, value in self._fields(record):
+            if name not in self.types:
+                if len(self.types) >= MAX_FIELDS:
+                    continue
+                self.types[name] = Counter()
+                self.examples[name] = []
+            kind = self.typer(value)
+            self.types[name][kind] += 1
+            examples = self.examples[name]
+            if kind in ("object", "array", "null", "empty"):
+                continue
+            example = value[:EXAMPLE_CHARS] if isinstance(value, str) else value
+            if len(examples) < EXAMPLES_PER_FIELD and example not in examples:
+                examples.append(example)
+
+    def render(self) -> List[str]:
+        lines = []
+        for name, types in self.types.items():
+            kinds = ", ".join(
+                f"{kind} {count / self.records:.0%}" for kind, count in types.most_common()
+            )
+            line = f"- {name}: {kinds}"
+            if self.examples[name]:
+                line += "; e.g. " + ", ".join(compact(e) for e in self.examples[name])
+            lines.append(line)
+        return lines
+
+
+def summarize_table(rows: Iterator[List[str]]) -> str:
+    """Full CSV text for small tables, else columns, types and sampled rows."""
+    header = next(rows, None)
+    if header is None:
+        return ""
+    sample = Reservoir(PROFILE_ROWS)
+    kept = [",".join(header)]
+    kept_chars = len(kept[0])
+    for row in rows:
+        if not row:
+            continue
+        sample.add(row)
+        if kept is not None:
+            kept.append(",".join(row))
+            kept_chars += len(kept[-1]) + 1
+            if kept_chars > FULL_TEXT_CHARS:
+                kept = None
+    if kept is not None:
+        return "\n".join(kept)
+
+    profile = Profile(cell_type)
+    for row in sample.sample():
+        profile.add(dict(zip(header, row)))
+    rows = sample.sample(data_sample_rows)
+    return "\n".join(
+        [
+            f"CSV table: {sample.seen} rows, {len(header)} columns",
+            f"Columns (from {profile.records} sampled rows):",
+            *profile.render(),
+            f"Sample of {len(rows)} rows:",
+            ",".join(header),
+            *(",".join(row)[:SAMPLE_CHARS] for row in rows),
+        ]
+    )
+
+
+def summarize_items(label: str, items: Iterable, dump: Callable[[List], str]) -> str:
+    """`dump` of all items when they are small, else their fields and a sample."""
+    sample = Reservoir(PROFILE_ROWS)
+    kept = []
+    budget = FULL_TEXT_CHARS
+    for item in items:
+        sample.add(item)
+        if kept is not None:
+            kept.append(item)
+            budget -= len(compact(item))
+            if budget < 0:
+                kept = None
+    if kept is not None:
+        return dump(kept)
+
+    profile = Profile()
+    for item in sample.sample():
+        profile.add(item)
+    items = sample.sample(data_sample_rows)
+    return "\n".join(
+        [
+            f"{label}: {sample.seen} items",
+            f"Fields (from {profile.records} sampled items):",
+            *profile.render(),
+            f"Sample of {len(items)} items:",
+            *(compact(item)[:SAMPLE_CHARS] for item in items),
+        ]
+    )
+
+
+def summarize_value(label: str, value, dump: Callable[[Any], str]) -> str:
+    """`dump` of a small value, else an outline with large arrays sampled."""
+    if fits(value, FULL_TEXT_CHARS):
+        return dump(value)
+    if isinstance(value, list):
+        return summarize_items(f"{label} array", value, dump)
+    if not isinstance(value, dict):
+        return compact(value)[:FULL_TEXT_CHARS]
+
+    lines = [f"{label} object with {len(value)} keys"]
+    for key, member in list(value.items())[:MAX_FIELDS]:
+        if isinstance(member, list) and not fits(member, SAMPLE_CHARS):
+            lines.append(f"{key}: " + summarize_items("array", member, compact))
+        else:
+            lines.append(f"{key}: {compact(member)[:SAMPLE_CHARS]}")
+    return "\n".join(lines)
+
+
+class JsonStream:
+    """Decodes consecutive JSON values from text chunks, holding one value at a time."""
+
+    def __init__(self, chunks: Iterator[str]):
+        self.chunks = chunks
+        self.buffer = ""
+        self.position = 0
+        self.decoder = json.JSONDecoder()
+
+    def grow(self) -> bool:
+        # Double the unread text, so retrying a long value stays linear overall
+        unread = self.buffer[self.position :]
+        wanted = max(2 * len(unread), 1)
+        parts = [unread]
+        size = len(unread)
+        for chunk in self.chunks:
+            parts.append(chunk)
+            size += len(chunk)
+            if size >= wanted:
+                break
+        self.buffer = "".join(parts)
+        self.position = 0
+        return size > len(unread)
+
+    def peek(self) -> str:
+        while True:
+            self.position = WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer) or not self.grow():
+                return self.buffer[self.position : self.position + 1]
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if not self.grow():
+                    raise
+                continue
+            # A number at the end of the buffer may go on in the next chunk
+            if end == len(self.buffer) and self.grow():
+                continue
+            self.position = end
+            return value
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if not char or char not in chars:
+            raise json.JSONDecodeError(
+                f"Expecting one of {chars!r}", self.buffer, self.position
+            )
+        self.position += 1
+        return char
+
+    def array_items(self) -> Iterator:
+        self.expect("[")
+        if self.peek() == "]":
+            return
+        while True:
+            yield self.decode()
+            if self.expect(",]") == "]":
+                return
+
+    def values(self) -> Iterator:
+        while self.peek():
+            yield self.decode()
+
+
+def iter_json(chunks: Iterator[str]) -> Tuple[str, Iterator]:
+    """Return ("array", items), ("lines", values) or ("value", [value]) for a JSON text.
+
+    Top-level arrays and JSON Lines are decoded one item at a time.
+    """
+    stream = JsonStream(chunks)
+    if stream.peek() == "[":
+        return "array", stream.array_items()
+    values = stream.values()
+    first = next(values, None)
+    if not stream.peek():
+        return "value", iter([first])
+    return "lines", chain([first], values)
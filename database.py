@@ -1,331 +1,710 @@
+import os
 import sqlite3
-from typing import List, Dict
+import queue
+import threading
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from heapq import merge
+from itertools import chain, islice
+from typing import Callable, List, Dict, Tuple
 import json
 import csv
 import io
 from datetime import datetime
 
+from config import shard_count, shard_roots
+
 DB_NAME = "files.db"
+# Databases the library is split into (see shard_path) and source roots pinned to them
+SHARDS = shard_count
+SHARD_ROOTS = shard_roots
+# Marks where each shard begins in an export
+SHARD_HEADER = "-- shard "
 
+# Callbacks told about every write, e.g. to keep in-memory indexes current
+_listeners = []
 
-def create_tables():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute(
-        """
-    CREATE TABLE IF NOT EXISTS files (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        title TEXT NOT NULL,
-        summary TEXT,
-        file_type TEXT,
-        path TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    """
-    )
+# Receives every executed statement, used by loadgen to check query plans
+_trace_callback = None
 
-    cursor.execute(
-        """
-    CREATE TABLE IF NOT EXISTS tags (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT UNIQUE
-    )
-    """
-    )
+# Pools of long-lived connections per shard, enabled by long-running processes (`un serve`)
+_pools: Dict[int, queue.LifoQueue] | None = None
 
-    cursor.execute(
-        """
-    CREATE TABLE IF NOT EXISTS file_tags (
-        file_id INTEGER,
-        tag_id INTEGER,
-        FOREIGN KEY (file_id) REFERENCES files(id),
-        FOREIGN KEY (tag_id) REFERENCES tags(id),
-        PRIMARY KEY (file_id, tag_id)
-    )
-    """
-    )
+# Distinct tag names across shards and the shard generations they were counted at
+_tag_total: Tuple[List[int], int] | None = None
 
-    conn.commit()
-    conn.close()
+# Threads running one query on every shard at once
+_fan_out_executor: ThreadPoolExecutor | None = None
+_fan_out_lock = threading.Lock()
 
 
-def add_file_to_db(file_meta: Dict):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute(
-        """
-        INSERT INTO files (title, summary, file_type, path)
-        VALUES (?, ?, ?, ?)
-    """,
-        (
-            file_meta["title"],
-            file_meta["summary"],
-            file_meta["file_type"],
-            file_meta["path"],
-        ),
-    )
+def trace_statements(callback):
+    global _trace_callback
+    _trace_callback = callback
 
-    file_id = cursor.lastrowid
 
-    for tag in file_meta["tags"]:
-        cursor.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag,))
-        cursor.execute("SELECT id FROM tags WHERE name = ?", (tag,))
-        tag_id = cursor.fetchone()[0]
+def use_persistent_connections():
+    global _pools
+    if _pools is None:
+        _pools = {}
 
-        cursor.execute(
-            "INSERT INTO file_tags (file_id, tag_id) VALUES (?, ?)", (file_id, tag_id)
-        )
 
-    conn.commit()
-    conn.close()
+def _open_persistent_connection(shard: int) -> sqlite3.Connection:
+    conn = sqlite3.connect(shard_path(shard), check_same_thread=False)
+    # WAL lets readers keep going while the single writer commits
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
 
 
-def find_files_by_tag(tag: str) -> List[Dict]:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute(
-        """
-    SELECT files.id, files.title, files.summary, files.file_type, files.path, files.created_at
-    FROM files
-    JOIN file_tags ON files.id = file_tags.file_id
-    JOIN tags ON file_tags.tag_id = tags.id
-    WHERE tags.name = ?
-    """,
-        (tag,),
-    )
+def add_change_listener(callback):
+    _listeners.append(callback)
 
-    rows = cursor.fetchall()
 
-    files = []
-    for row in rows:
-        file = {
-            "id": row[0],
-            "title": row[1],
-            "summary": row[2],
-            "file_type": row[3],
-            "path": row[4],
-            "created_at": row[5],
-        }
-        files.append(file)
+def _notify(event: str, **data):
+    for callback in _listeners:
+        callback(event, **data)
 
-    conn.close()
-    return files
 
+def read_generation(cursor) -> int:
+    cursor.execute("SELECT generation FROM library_meta")
+    row = cursor.fetchone()
+    return row[0] if row else 0
 
-def get_all_tags() -> List[str]:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
 
-    cursor.execute(
-        """
-    SELECT tags.name
-    FROM tags
+def _bump_generation(cursor) -> int:
+    # Lets other processes notice that their cached view of the library is stale
+    cursor.execute("UPDATE library_meta SET generation = generation + 1")
+    return read_generation(cursor)
+
+
+def _shard_generation(shard: int) -> int:
+    with get_connection(shard) as conn:
+        return read_generation(conn.cursor())
+
+
+def get_generations() -> List[int]:
+    return fan_out(_shard_generation)
+
+
+def get_generation() -> int:
+    """Generation of the whole library: the sum over its shards."""
+    return sum(get_generations())
+
+
+# Sharding
+
+
+def shard_path(shard: int) -> str:
+    """Shard 0 is DB_NAME itself, so a single-database library is a one-shard library."""
+    if shard == 0:
+        return DB_NAME
+    stem, extension = os.path.splitext(DB_NAME)
+    return f"{stem}.{shard}{extension}"
+
+
+def shard_for_path(path: str) -> int:
+    """Shard a document is stored in: its source root's, or else by a hash of its path."""
+    for position, root in enumerate(SHARD_ROOTS):
+        root = root.rstrip("/")
+        if path == root or path.startswith(f"{root}/"):
+            return position % SHARDS
+    # Archive members (archive.zip!/member) are kept with their archive
+    return zlib.crc32(path.split("!/", 1)[0].encode()) % SHARDS
+
+
+def global_id(local_id: int, shard: int) -> int:
+    return local_id * SHARDS + shard
+
+
+def split_id(file_id: int) -> Tuple[int, int]:
+    """Return the shard of a file id and the row id within that shard."""
+    return file_id % SHARDS, file_id // SHARDS
+
+
+def fan_out(query: Callable[[int], object]) -> List:
+    """Run query(shard) for every shard, in parallel, and return the results in shard order.
+
+    SQLite releases the GIL while it executes a statement, so threads are enough.
     """
-    )
+    global _fan_out_executor
+    if SHARDS == 1:
+        return [query(0)]
+    with _fan_out_lock:
+        if _fan_out_executor is None:
+            _fan_out_executor = ThreadPoolExecutor(max_workers=min(32, SHARDS * 4))
+    return list(_fan_out_executor.map(query, range(SHARDS)))
+
+
+def _merged(per_shard: List[List[Dict]], limit: int | None = None) -> List[Dict]:
+    # Every shard lists its files by row id, and global ids keep that order
+    return list(islice(merge(*per_shard, key=lambda file: file["id"]), limit))
+
+
+@contextmanager
+def get_connection(shard: int = 0):
+    if _pools is None:
+        conn = sqlite3.connect(shard_path(shard))
+        conn.set_trace_callback(_trace_callback)
+        try:
+            yield conn
+        finally:
+            conn.close()
+        return
+
+    pool = _pools.setdefault(shard, queue.LifoQueue())
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_persistent_connection(shard)
+    conn.set_trace_callback(_trace_callback)
+    try:
+        yield conn
+    finally:
+        # Never hand a connection with a half-done transaction back to the pool
+        conn.rollback()
+        pool.put(conn)
+
+
+# Tag names are aggregated per file with a separator that cannot appear in tags
+TAG_SEPARATOR = "\x1f"
+FILE_COLUMNS_WITH_TAGS = f"""
+    f.id, f.title, f.summary, f.file_type, f.path, f.created_at,
+    GROUP_CONCAT(t.name, char({ord(TAG_SEPARATOR)}))
+"""
+TAGS_JOIN = """
+    LEFT JOIN file_tags ft ON ft.file_id = f.id
+    LEFT JOIN tags t ON t.id = ft.tag_id
+"""
+
+
+def _file_with_tags(row, shard: int = 0) -> Dict:
+    return {
+        "id": global_id(row[0], shard),
+        "title": row[1],
+        "summary": row[2],
+        "file_type": row[3],
+        "path": row[4],
+        "created_at": row[5],
+        "tags": row[6].split(TAG_SEPARATOR) if row[6] else [],
+    }
+
+
+def compute_facets(files: List[Dict], limit: int = 10) -> Dict[str, Dict]:
+    """Count tags, file types and creation months over a result set in one pass."""
+    tags, file_types, months = Counter(), Counter(), Counter()
+    for file in files:
+        tags.update(file["tags"])
+        file_types[file["file_type"]] += 1
+        months[(file["created_at"] or "")[:7]] += 1
+    return {
+        "tags": dict(tags.most_common(limit)),
+        "file_type": dict(file_types.most_common(limit)),
+        "month": dict(months.most_common(limit)),
+    }
 
-    rows = [i[0] for i in cursor.fetchall()]
 
-    return rows
+def create_tables():
+    for shard in range(SHARDS):
+        with get_connection(shard) as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(
+                """
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                summary TEXT,
+                file_type TEXT,
+                path TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                provisional INTEGER DEFAULT 0
+            )
+            """
+            )
+
+            # Databases created before triage mode lack the provisional flag
+            cursor.execute("PRAGMA table_info(files)")
+            if "provisional" not in [row[1] for row in cursor.fetchall()]:
+                cursor.execute("ALTER TABLE files ADD COLUMN provisional INTEGER DEFAULT 0")
+
+            cursor.execute(
+                """
+            CREATE TABLE IF NOT EXISTS tags (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT UNIQUE
+            )
+            """
+            )
+
+            cursor.execute(
+                """
+            CREATE TABLE IF NOT EXISTS file_tags (
+                file_id INTEGER,
+                tag_id INTEGER,
+                FOREIGN KEY (file_id) REFERENCES files(id),
+                FOREIGN KEY (tag_id) REFERENCES tags(id),
+                PRIMARY KEY (file_id, tag_id)
+            )
+            """
+            )
+
+            # Tag filters look up files by tag, date listings by creation time
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_file_tags_tag ON file_tags (tag_id, file_id)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_files_created_at ON files (created_at)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_files_file_type ON files (file_type)"
+            )
+
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS library_meta (generation INTEGER NOT NULL)"
+            )
+            cursor.execute(
+                """
+            INSERT INTO library_meta (generation)
+            SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM library_meta)
+            """
+            )
 
+            conn.commit()
 
-def search_files(keywords: str) -> List[Dict]:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    search_terms = f"%{keywords}%"
-    cursor.execute(
-        """
-        SELECT id, title, summary, file_type, path, created_at
-        FROM files
-        WHERE title LIKE ? OR summary LIKE ?
-    """,
-        (search_terms, search_terms),
-    )
-    rows = cursor.fetchall()
-    files = [
-        {
-            "id": row[0],
-            "title": row[1],
-            "summary": row[2],
-            "file_type": row[3],
-            "path": row[4],
-            "created_at": row[5],
-        }
-        for row in rows
-    ]
-    conn.close()
-    return files
-
-
-def filter_by_tags(tags: List[str]) -> List[Dict]:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    placeholders = ",".join("?" for _ in tags)
-    cursor.execute(
-        f"""
-        SELECT DISTINCT f.id, f.title, f.summary, f.file_type, f.path, f.created_at
-        FROM files f
-        JOIN file_tags ft ON f.id = ft.file_id
-        JOIN tags t ON ft.tag_id = t.id
-        WHERE t.name IN ({placeholders})
-    """,
-        tags,
-    )
-    rows = cursor.fetchall()
-    files = [
-        {
-            "id": row[0],
-            "title": row[1],
-            "summary": row[2],
-            "file_type": row[3],
-            "path": row[4],
-            "created_at": row[5],
-        }
-        for row in rows
-    ]
-    conn.close()
-    return files
 
+def add_file_to_db(file_meta: Dict):
+    shard = shard_for_path(file_meta["path"])
+    with get_connection(shard) as conn:
+        cursor = conn.cursor()
 
-def get_stats(stat_type: str | None = None) -> Dict:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    if stat_type == "file_type":
-        cursor.execute("SELECT file_type, COUNT(*) FROM files GROUP BY file_type")
-    elif stat_type == "tag":
         cursor.execute(
             """
-            SELECT t.name, COUNT(DISTINCT ft.file_id)
-            FROM tags t
-            JOIN file_tags ft ON t.id = ft.tag_id
-            GROUP BY t.name
-        """
+            INSERT INTO files (title, summary, file_type, path, provisional)
+            VALUES (?, ?, ?, ?, ?)
+        """,
+            (
+                file_meta["title"],
+                file_meta["summary"],
+                file_meta["file_type"],
+                file_meta["path"],
+                int(file_meta.get("provisional", False)),
+            ),
         )
-    else:
-        cursor.execute("SELECT COUNT(*) FROM files")
-        file_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM tags")
-        tag_count = cursor.fetchone()[0]
-        conn.close()
-        return {"total_files": file_count, "total_tags": tag_count}
 
-    results = dict(cursor.fetchall())
-    conn.close()
-    return results
+        local_id = cursor.lastrowid
+
+        for tag in file_meta["tags"]:
+            cursor.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag,))
+            cursor.execute("SELECT id FROM tags WHERE name = ?", (tag,))
+            tag_id = cursor.fetchone()[0]
+
+            cursor.execute(
+                "INSERT INTO file_tags (file_id, tag_id) VALUES (?, ?)",
+                (local_id, tag_id),
+            )
+
+        generation = _bump_generation(cursor)
+        conn.commit()
+    file_id = global_id(local_id, shard)
+    _notify(
+        "add_file",
+        file_id=file_id,
+        file_type=file_meta["file_type"],
+        tags=file_meta["tags"],
+        generations={shard: generation},
+    )
+    return file_id
+
+
+def find_files_by_tag(tag: str) -> List[Dict]:
+    def find(shard):
+        with get_connection(shard) as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(
+                """
+            SELECT files.id, files.title, files.summary, files.file_type, files.path, files.created_at
+            FROM files
+            JOIN file_tags ON files.id = file_tags.file_id
+            JOIN tags ON file_tags.tag_id = tags.id
+            WHERE tags.name = ?
+            ORDER BY files.id
+            """,
+                (tag,),
+            )
+
+            rows = cursor.fetchall()
+
+            files = []
+            for row in rows:
+                file = {
+                    "id": global_id(row[0], shard),
+                    "title": row[1],
+                    "summary": row[2],
+                    "file_type": row[3],
+                    "path": row[4],
+                    "created_at": row[5],
+                }
+                files.append(file)
+
+            return files
+
+    return _merged(fan_out(find))
+
+
+def get_all_tags() -> List[str]:
+    def tags(shard):
+        with get_connection(shard) as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(
+                """
+            SELECT tags.name
+            FROM tags
+            """
+            )
+
+            rows = [i[0] for i in cursor.fetchall()]
+
+            return rows
+
+    # A name used in several shards is listed once
+    return list(dict.fromkeys(chain.from_iterable(fan_out(tags))))
+
+
+def _sql_limit(limit: int | None) -> int:
+    # In SQLite, LIMIT -1 means no limit
+    return -1 if limit is None else limit
+
+
+def search_files(keywords: str, limit: int | None = None) -> List[Dict]:
+    def search(shard):
+        with get_connection(shard) as conn:
+            cursor = conn.cursor()
+            search_terms = f"%{keywords}%"
+            cursor.execute(
+                f"""
+                SELECT {FILE_COLUMNS_WITH_TAGS}
+                FROM files f
+                {TAGS_JOIN}
+                WHERE f.title LIKE ? OR f.summary LIKE ?
+                GROUP BY f.id
+                ORDER BY f.id
+                LIMIT ?
+            """,
+                (search_terms, search_terms, _sql_limit(limit)),
+            )
+            return [_file_with_tags(row, shard) for row in cursor.fetchall()]
+
+    return _merged(fan_out(search), limit)
+
+
+def filter_by_tags(tags: List[str], limit: int | None = None) -> List[Dict]:
+    def filter_shard(shard):
+        with get_connection(shard) as conn:
+            cursor = conn.cursor()
+            placeholders = ",".join("?" for _ in tags)
+            cursor.execute(
+                f"""
+                SELECT {FILE_COLUMNS_WITH_TAGS}
+                FROM files f
+                {TAGS_JOIN}
+                WHERE f.id IN (
+                    SELECT ft.file_id
+                    FROM file_tags ft
+                    JOIN tags t ON ft.tag_id = t.id
+                    WHERE t.name IN ({placeholders})
+                )
+                GROUP BY f.id
+                ORDER BY f.id
+                LIMIT ?
+            """,
+                [*tags, _sql_limit(limit)],
+            )
+            return [_file_with_tags(row, shard) for row in cursor.fetchall()]
+
+    return _merged(fan_out(filter_shard), limit)
+
+
+def select_files(condition: str, params: List, limit: int | None = None) -> List[Dict]:
+    """Files matching an SQL condition on `files f`, such as one built by query_index."""
+
+    def select(shard):
+        with get_connection(shard) as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""
+                SELECT {FILE_COLUMNS_WITH_TAGS}
+                FROM files f
+                {TAGS_JOIN}
+                WHERE {condition}
+                GROUP BY f.id
+                ORDER BY f.id
+                LIMIT ?
+            """,
+                [*params, _sql_limit(limit)],
+            )
+            return [_file_with_tags(row, shard) for row in cursor.fetchall()]
+
+    return _merged(fan_out(select), limit)
+
+
+def get_stats(stat_type: str | None = None) -> Dict:
+    def stats(shard):
+        with get_connection(shard) as conn:
+            cursor = conn.cursor()
+            if stat_type == "file_type":
+                cursor.execute("SELECT file_type, COUNT(*) FROM files GROUP BY file_type")
+                return cursor.fetchall()
+            if stat_type == "tag":
+                cursor.execute(
+                    """
+                    SELECT t.name, counts.file_count
+                    FROM (
+                        SELECT tag_id, COUNT(*) AS file_count
+                        FROM file_tags
+                        GROUP BY tag_id
+                    ) counts
+                    JOIN tags t ON t.id = counts.tag_id
+                """
+                )
+                return cursor.fetchall()
+            cursor.execute("SELECT COUNT(*) FROM files")
+            file_count = cursor.fetchone()[0]
+            if SHARDS == 1:
+                cursor.execute("SELECT COUNT(*) FROM tags")
+                return file_count, cursor.fetchone()[0]
+            return file_count, read_generation(cursor)
+
+    per_shard = fan_out(stats)
+    if stat_type in ("file_type", "tag"):
+        results = {}
+        for rows in per_shard:
+            for key, count in rows:
+                results[key] = results.get(key, 0) + count
+        return results
+    file_counts, tags = zip(*per_shard)
+    tag_count = tags[0] if SHARDS == 1 else _distinct_tag_count(list(tags))
+    return {"total_files": sum(file_counts), "total_tags": tag_count}
+
+
+def _distinct_tag_count(generations: List[int]) -> int:
+    # A tag used in several shards is counted once, which takes every name in
+    # every shard, so the total is only recounted after a write
+    global _tag_total
+    cached = _tag_total
+    if cached is not None and cached[0] == generations:
+        return cached[1]
+    count = len(get_all_tags())
+    _tag_total = (generations, count)
+    return count
 
 
 def add_tag(file_id: int, tag: str):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag,))
-    cursor.execute("SELECT id FROM tags WHERE name = ?", (tag,))
-    tag_id = cursor.fetchone()[0]
-    cursor.execute(
-        "INSERT OR IGNORE INTO file_tags (file_id, tag_id) VALUES (?, ?)",
-        (file_id, tag_id),
-    )
-    conn.commit()
-    conn.close()
+    shard, local_id = split_id(file_id)
+    with get_connection(shard) as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag,))
+        cursor.execute("SELECT id FROM tags WHERE name = ?", (tag,))
+        tag_id = cursor.fetchone()[0]
+        cursor.execute(
+            "INSERT OR IGNORE INTO file_tags (file_id, tag_id) VALUES (?, ?)",
+            (local_id, tag_id),
+        )
+        generation = _bump_generation(cursor)
+        conn.commit()
+    _notify("add_tag", file_id=file_id, tag=tag, generations={shard: generation})
 
 
 def rename_tag(old_name: str, new_name: str):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE tags SET name = ? WHERE name = ?", (new_name, old_name))
-    conn.commit()
-    conn.close()
+    # Each shard has its own tags table, renamed in its own transaction
+    generations = {}
+    for shard in range(SHARDS):
+        with get_connection(shard) as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE tags SET name = ? WHERE name = ?", (new_name, old_name))
+            generations[shard] = _bump_generation(cursor)
+            conn.commit()
+    _notify("rename_tag", old_name=old_name, new_name=new_name, generations=generations)
 
 
 def export_db(file):
-    conn = sqlite3.connect(DB_NAME)
-    for line in conn.iterdump():
-        file.write(f"{line}\n")
-    conn.close()
+    for shard in range(SHARDS):
+        if SHARDS > 1:
+            file.write(f"{SHARD_HEADER}{shard}\n")
+        with get_connection(shard) as conn:
+            for line in conn.iterdump():
+                file.write(f"{line}\n")
 
 
 def import_db(file):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.executescript(file.read())
-    conn.commit()
-    conn.close()
+    # Dumps of a single database, or without shard headers, go to shard 0
+    scripts = {0: []}
+    shard = 0
+    for line in file:
+        if line.startswith(SHARD_HEADER):
+            shard = int(line[len(SHARD_HEADER) :])
+            if shard >= SHARDS:
+                raise ValueError(
+                    f"The dump has more shards than the {SHARDS} configured in shard_count"
+                )
+            scripts[shard] = []
+            continue
+        scripts[shard].append(line)
+    for shard, lines in scripts.items():
+        with get_connection(shard) as conn:
+            cursor = conn.cursor()
+            cursor.executescript("".join(lines))
+            _bump_generation(cursor)
+            conn.commit()
+    _notify("reset")
 
 
 def get_file_by_id(file_id: int) -> Dict | None:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, title, summary, file_type, path, created_at FROM files WHERE id = ?",
-        (file_id,),
-    )
-    row = cursor.fetchone()
-    conn.close()
-    if row:
-        return {
-            "id": row[0],
-            "title": row[1],
-            "summary": row[2],
-            "file_type": row[3],
-            "path": row[4],
-            "created_at": row[5],
-        }
-    return None
+    shard, local_id = split_id(file_id)
+    with get_connection(shard) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, title, summary, file_type, path, created_at FROM files WHERE id = ?",
+            (local_id,),
+        )
+        row = cursor.fetchone()
+        if row:
+            return {
+                "id": file_id,
+                "title": row[1],
+                "summary": row[2],
+                "file_type": row[3],
+                "path": row[4],
+                "created_at": row[5],
+            }
+        return None
+
+
+def get_files_by_ids(file_ids: List[int]) -> List[Dict]:
+    local_ids = {}
+    for file_id in file_ids:
+        shard, local_id = split_id(file_id)
+        local_ids.setdefault(shard, []).append(local_id)
+
+    def fetch(shard):
+        files = []
+        ids = sorted(local_ids.get(shard, ()))
+        if not ids:
+            return files
+        with get_connection(shard) as conn:
+            cursor = conn.cursor()
+            # Stay below SQLite's limit on bound parameters per statement
+            for start in range(0, len(ids), 900):
+                chunk = ids[start : start + 900]
+                placeholders = ",".join("?" for _ in chunk)
+                cursor.execute(
+                    f"""
+                    SELECT {FILE_COLUMNS_WITH_TAGS}
+                    FROM files f
+                    {TAGS_JOIN}
+                    WHERE f.id IN ({placeholders})
+                    GROUP BY f.id
+                    ORDER BY f.id
+                """,
+                    chunk,
+                )
+                files.extend(_file_with_tags(row, shard) for row in cursor.fetchall())
+        return files
+
+    return _merged(fan_out(fetch))
 
 
 def update_file_tags(file_id: int, tags: List[str]):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM file_tags WHERE file_id = ?", (file_id,))
-    for tag in tags:
-        cursor.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag,))
-        cursor.execute("SELECT id FROM tags WHERE name = ?", (tag,))
-        tag_id = cursor.fetchone()[0]
+    shard, local_id = split_id(file_id)
+    with get_connection(shard) as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM file_tags WHERE file_id = ?", (local_id,))
+        for tag in tags:
+            cursor.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag,))
+            cursor.execute("SELECT id FROM tags WHERE name = ?", (tag,))
+            tag_id = cursor.fetchone()[0]
+            cursor.execute(
+                "INSERT INTO file_tags (file_id, tag_id) VALUES (?, ?)",
+                (local_id, tag_id),
+            )
+        generation = _bump_generation(cursor)
+        conn.commit()
+    _notify("set_tags", file_id=file_id, tags=tags, generations={shard: generation})
+
+
+def update_file_meta(file_id: int, file_meta: Dict):
+    shard, local_id = split_id(file_id)
+    with get_connection(shard) as conn:
+        cursor = conn.cursor()
         cursor.execute(
-            "INSERT INTO file_tags (file_id, tag_id) VALUES (?, ?)", (file_id, tag_id)
+            "UPDATE files SET title = ?, summary = ?, provisional = ? WHERE id = ?",
+            (
+                file_meta["title"],
+                file_meta["summary"],
+                int(file_meta.get("provisional", False)),
+                local_id,
+            ),
         )
-    conn.commit()
-    conn.close()
-
-
-def list_files(date_after: str | None = None) -> List[Dict]:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    query = "SELECT id, title, summary, file_type, path, created_at FROM files"
-    params = ()
-    if date_after:
-        query += " WHERE created_at > ?"
-        params = (date_after,)
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
-    files = [
-        {
-            "id": row[0],
-            "title": row[1],
-            "summary": row[2],
-            "file_type": row[3],
-            "path": row[4],
-            "created_at": row[5],
-        }
-        for row in rows
-    ]
-    conn.close()
-    return files
+        cursor.execute("DELETE FROM file_tags WHERE file_id = ?", (local_id,))
+        for tag in file_meta["tags"]:
+            cursor.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag,))
+            cursor.execute("SELECT id FROM tags WHERE name = ?", (tag,))
+            tag_id = cursor.fetchone()[0]
+            cursor.execute(
+                "INSERT OR IGNORE INTO file_tags (file_id, tag_id) VALUES (?, ?)",
+                (local_id, tag_id),
+            )
+        generation = _bump_generation(cursor)
+        conn.commit()
+    _notify(
+        "set_tags", file_id=file_id, tags=file_meta["tags"], generations={shard: generation}
+    )
+
+
+def list_provisional_files() -> List[Dict]:
+    def provisional(shard):
+        with get_connection(shard) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, path FROM files WHERE provisional = 1 ORDER BY id")
+            return [
+                {"id": global_id(row[0], shard), "path": row[1]} for row in cursor.fetchall()
+            ]
+
+    return _merged(fan_out(provisional))
+
+
+def list_files(date_after: str | None = None, limit: int | None = None) -> List[Dict]:
+    def list_shard(shard):
+        with get_connection(shard) as conn:
+            cursor = conn.cursor()
+            query = f"SELECT {FILE_COLUMNS_WITH_TAGS} FROM files f {TAGS_JOIN}"
+            params = ()
+            if date_after:
+                # As a subquery, so the date index is used rather than a scan in id order
+                query += " WHERE f.id IN (SELECT id FROM files WHERE created_at > ?)"
+                params = (date_after,)
+            query += " GROUP BY f.id ORDER BY f.id LIMIT ?"
+            cursor.execute(query, (*params, _sql_limit(limit)))
+            return [_file_with_tags(row, shard) for row in cursor.fetchall()]
+
+    return _merged(fan_out(list_shard), limit)
 
 
 def get_tags_for_file(file_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT tags.name
-        FROM tags
-        JOIN file_tags ON tags.id = file_tags.tag_id
-        WHERE file_tags.file_id = ?
-    """,
-        (file_id,),
-    )
-    tags = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return tags
+    shard, local_id = split_id(file_id)
+    with get_connection(shard) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT tags.name
+            FROM tags
+            JOIN file_tags ON tags.id = file_tags.tag_id
+            WHERE file_tags.file_id = ?
+        """,
+            (local_id,),
+        )
+        tags = [row[0] for row in cursor.fetchall()]
+        return tags
@@ -1,5 +1,15 @@
+import codecs
+import io
+import mmap
 import os
-from typing import Callable, Dict
+import re
+import shutil
+import subprocess
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from importlib.metadata import entry_points
+from itertools import chain, islice
+from typing import IO, Callable, Dict, Iterable, Iterator
 import zipfile
 import xml.etree.ElementTree as ET
 from docx import Document
@@ -7,12 +17,14 @@ from openpyxl import load_workbook
 from pptx import Presentation
 from PyPDF2 import PdfReader
 import csv
-import chardet
+from chardet.universaldetector import UniversalDetector
 import json
 import yaml
 import markdown
 from bs4 import BeautifulSoup
 import email
+import email.policy
+from email.message import EmailMessage
 import ebooklib
 from ebooklib import epub
 from mobi import extract as mobi_extract
@@ -20,10 +32,129 @@ import html2text
 import tempfile
 import requests
 from urllib.parse import urlparse
-
-
-def extract_epub(file_path: str) -> str:
-    book = epub.read_epub(file_path)
+from config import benchmark_file, max_text_chars, max_garbage_score
+from data_summary import compact, iter_json, summarize_items, summarize_table, summarize_value
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+
+try:
+    import xlrd
+except ImportError:
+    xlrd = None
+
+PLUGIN_GROUP = "untangle.extractors"
+CHUNK_SIZE = 1024 * 1024
+DETECT_SIZE = 64 * 1024
+CSV_SNIFF_LINES = 50
+GARBAGE_SAMPLE_CHARS = 100_000
+# Control characters, replacement characters from failed decoding and private use glyphs
+GARBAGE_PATTERN = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f\ufffd\ue000-\uf8ff]")
+
+
+# Extractors accept a filesystem path or a seekable binary stream (archive members)
+Source = str | IO[bytes]
+
+
+@contextmanager
+def open_binary(source: Source):
+    if isinstance(source, str):
+        with open(source, "rb") as file:
+            yield file
+    else:
+        yield source
+
+
+@contextmanager
+def open_text(source: Source, encoding: str = "utf-8", **kwargs):
+    with open_binary(source) as file:
+        wrapper = io.TextIOWrapper(file, encoding=encoding, **kwargs)
+        try:
+            yield wrapper
+        finally:
+            # Leave the underlying stream to its owner
+            wrapper.detach()
+
+
+def iter_chunks(source: Source) -> Iterator[bytes | memoryview]:
+    """Yield the bytes of a source in chunks, mapping real files instead of reading them."""
+    if isinstance(source, str):
+        with open(source, "rb") as file:
+            try:
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Empty files and pipes cannot be mapped
+                yield from iter_chunks(file)
+                return
+            with mapped, memoryview(mapped) as view:
+                for start in range(0, len(view), CHUNK_SIZE):
+                    with view[start : start + CHUNK_SIZE] as chunk:
+                        yield chunk
+        return
+    while chunk := source.read(CHUNK_SIZE):
+        yield chunk
+
+
+def detect_encoding(data: bytes | memoryview) -> str | None:
+    detector = UniversalDetector()
+    for start in range(0, len(data), DETECT_SIZE):
+        detector.feed(data[start : start + DETECT_SIZE])
+        if detector.done:
+            break
+    detector.close()
+    return detector.result.get("encoding")
+
+
+def iter_decoded(
+    chunks: Iterable[bytes | memoryview], encoding: str, errors: str = "strict"
+) -> Iterator[str]:
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    for chunk in chunks:
+        if text := decoder.decode(chunk):
+            yield text
+    if text := decoder.decode(b"", final=True):
+        yield text
+
+
+def iter_lines(texts: Iterable[str]) -> Iterator[str]:
+    pending = ""
+    for text in texts:
+        lines = (pending + text).splitlines(keepends=True)
+        # "\r" may be the first half of a "\r\n" in the next chunk
+        pending = lines.pop() if lines and not lines[-1].endswith("\n") else ""
+        yield from lines
+    if pending:
+        yield pending
+
+
+def join_limited(texts: Iterable[str], limit: int = max_text_chars) -> str:
+    parts, size = [], 0
+    for text in texts:
+        if limit and size + len(text) >= limit:
+            parts.append(text[: limit - size])
+            break
+        parts.append(text)
+        size += len(text)
+    return "".join(parts)
+
+
+@contextmanager
+def local_path(source: Source, suffix: str = ""):
+    """Yield a real path for backends that cannot read from a stream."""
+    if isinstance(source, str):
+        yield source
+        return
+    with tempfile.NamedTemporaryFile(suffix=suffix) as file:
+        shutil.copyfileobj(source, file)
+        file.flush()
+        yield file.name
+
+
+def extract_epub(source: Source) -> str:
+    with local_path(source, ".epub") as file_path:
+        book = epub.read_epub(file_path)
     text = []
     for item in book.get_items():
         if item.get_type() == ebooklib.ITEM_DOCUMENT:
@@ -31,20 +162,78 @@ def extract_epub(file_path: str) -> str:
     return "\n".join(text)
 
 
-def extract_fb2(file_path: str) -> str:
-    with open(file_path, "rb") as file:
-        content = file.read()
-    soup = BeautifulSoup(content, "xml")
-    return " ".join(soup.stripped_strings)
+class Fb2Text:
+    """XML parser target collecting text in document order without building a tree."""
+
+    def __init__(self):
+        self.parts = []
+        self.pending = []
+        self.size = 0
+        # Depth inside <binary>, which holds base64 images
+        self.binary = 0
+
+    def flush(self):
+        text = "".join(self.pending).strip()
+        self.pending.clear()
+        if text:
+            self.parts.append(text)
+            self.size += len(text) + 1
+
+    def start(self, tag, attrib):
+        self.flush()
+        if tag.rsplit("}", 1)[-1] == "binary":
+            self.binary += 1
 
+    def end(self, tag):
+        self.flush()
+        if tag.rsplit("}", 1)[-1] == "binary":
+            self.binary -= 1
 
-def extract_docx(file_path: str) -> str:
-    doc = Document(file_path)
+    def data(self, data):
+        if not self.binary:
+            self.pending.append(data)
+
+    def close(self) -> str:
+        self.flush()
+        text = " ".join(self.parts)
+        return text[:max_text_chars] if max_text_chars else text
+
+
+def extract_fb2(source: Source) -> str:
+    target = Fb2Text()
+    parser = ET.XMLParser(target=target)
+    try:
+        for chunk in iter_chunks(source):
+            parser.feed(bytes(chunk))
+            if max_text_chars and target.size >= max_text_chars:
+                break
+    except ET.ParseError:
+        # Keep the text before the damage, as lenient parsers would
+        if target.parts:
+            return target.close()
+        # Broken before any text, e.g. HTML entities like &nbsp; in the header
+        if not isinstance(source, str):
+            source.seek(0)
+        return extract_fb2_lenient(source)
+    return target.close()
+
+
+def extract_fb2_lenient(source: Source) -> str:
+    with open_binary(source) as file:
+        soup = BeautifulSoup(file.read(), "xml")
+    for binary in soup.find_all("binary"):
+        binary.decompose()
+    text = " ".join(soup.stripped_strings)
+    return text[:max_text_chars] if max_text_chars else text
+
+
+def extract_docx(source: Source) -> str:
+    doc = Document(source)
     return "\n".join(paragraph.text for paragraph in doc.paragraphs)
 
 
-def extract_xlsx(file_path: str) -> str:
-    wb = load_workbook(file_path)
+def extract_xlsx(source: Source) -> str:
+    wb = load_workbook(source)
     return "\n".join(
         str(cell.value)
         for sheet in wb.worksheets
@@ -54,8 +243,8 @@ def extract_xlsx(file_path: str) -> str:
     )
 
 
-def extract_pptx(file_path: str) -> str:
-    prs = Presentation(file_path)
+def extract_pptx(source: Source) -> str:
+    prs = Presentation(source)
     return "\n".join(
         shape.text
         for slide in prs.slides
@@ -64,67 +253,105 @@ def extract_pptx(file_path: str) -> str:
     )
 
 
-def extract_pdf(file_path: str) -> str:
-    reader = PdfReader(file_path)
+def extract_pdf(source: Source) -> str:
+    reader = PdfReader(source)
     return "\n".join(page.extract_text() for page in reader.pages)
 
 
-def extract_opendocument(file_path: str) -> str:
-    with zipfile.ZipFile(file_path) as zf:
+def extract_opendocument(source: Source) -> str:
+    with zipfile.ZipFile(source) as zf:
         content = zf.read("content.xml")
     root = ET.fromstring(content)
     return "\n".join(elem.text for elem in root.iter() if elem.text)
 
 
-def extract_text_with_encoding(file_path: str) -> str | None:
-    with open(file_path, "rb") as file:
-        raw_data = file.read()
-
-    chardet_data = chardet.detect(raw_data)
-    encoding = chardet_data.get("encoding")
+def extract_text_with_encoding(source: Source) -> str | None:
+    chunks = iter_chunks(source)
+    head = next(chunks, b"")
+    encoding = detect_encoding(head)
 
     if encoding is None:
         return None
 
-    return raw_data.decode(encoding)
+    return join_limited(iter_decoded(chain([head], chunks), encoding))
+
+
+def extract_csv(source: Source) -> str:
+    lines = iter_lines(iter_decoded(iter_chunks(source), "utf-8-sig"))
+    head = list(islice(lines, CSV_SNIFF_LINES))
+    try:
+        dialect = csv.Sniffer().sniff("".join(head), delimiters=",;\t|")
+    except csv.Error:
+        dialect = csv.excel
+    return summarize_table(csv.reader(chain(head, lines), dialect))
+
 
+def dump_json(value) -> str:
+    return json.dumps(value, indent=2, ensure_ascii=False)
 
-def extract_csv(file_path: str) -> str:
-    with open(file_path, "r", newline="", encoding="utf-8") as csvfile:
-        reader = csv.reader(csvfile)
-        return "\n".join(",".join(row) for row in reader)
 
+def extract_json(source: Source) -> str:
+    kind, values = iter_json(iter_decoded(iter_chunks(source), "utf-8-sig"))
+    if kind == "array":
+        return summarize_items("JSON array", values, dump_json)
+    if kind == "lines":
+        return summarize_items("JSON lines", values, lambda items: "\n".join(map(compact, items)))
+    return summarize_value("JSON", next(values), dump_json)
 
-def extract_json(file_path: str) -> str:
-    with open(file_path, "r", encoding="utf-8") as file:
-        return json.dumps(json.load(file), indent=2)
 
+def dump_yaml(value) -> str:
+    return yaml.dump(value, default_flow_style=False, allow_unicode=True)
 
-def extract_yaml(file_path: str) -> str:
-    with open(file_path, "r", encoding="utf-8") as file:
-        return yaml.dump(yaml.safe_load(file), default_flow_style=False)
 
+def extract_yaml(source: Source) -> str:
+    with open_binary(source) as file:
+        # Documents are loaded one at a time; the reader decodes incrementally
+        documents = yaml.safe_load_all(file)
+        first = list(islice(documents, 2))
+        if len(first) < 2:
+            return summarize_value("YAML", first[0] if first else None, dump_yaml)
+        return summarize_items(
+            "YAML documents",
+            chain(first, documents),
+            lambda docs: "---\n".join(map(dump_yaml, docs)),
+        )
 
-def extract_markdown(file_path: str) -> str:
-    with open(file_path, "r", encoding="utf-8") as file:
+
+def extract_markdown(source: Source) -> str:
+    with open_text(source) as file:
         return markdown.markdown(file.read())
 
 
-def extract_html(file_path: str) -> str:
-    with open(file_path, "r", encoding="utf-8") as file:
+def extract_html(source: Source) -> str:
+    with open_text(source) as file:
         soup = BeautifulSoup(file, "html.parser")
         return soup.get_text()
 
 
-def extract_xml(file_path: str) -> str:
-    tree = ET.parse(file_path)
+def extract_xml(source: Source) -> str:
+    tree = ET.parse(source)
     return ET.tostring(tree.getroot(), encoding="unicode", method="text")
 
 
-def extract_eml(file_path: str) -> str:
-    with open(file_path, "r", encoding="utf-8") as file:
-        msg = email.message_from_file(file)
-        return f"Subject: {msg['subject']}\nFrom: {msg['from']}\nTo: {msg['to']}\n\n{msg.get_payload()}"
+def read_email(source: Source) -> EmailMessage:
+    with open_binary(source) as file:
+        return email.message_from_binary_file(file, policy=email.policy.default)
+
+
+def extract_eml(source: Source) -> str:
+    msg = read_email(source)
+    body = msg.get_body(preferencelist=("plain", "html"))
+    text = ""
+    if body is not None:
+        text = body.get_content()
+        if body.get_content_type() == "text/html":
+            text = BeautifulSoup(text, "html.parser").get_text()
+    # Attachments are indexed on their own, see archives.iter_documents
+    attachments = [part.get_filename() or "" for part in msg.iter_attachments()]
+    header = f"Subject: {msg['subject']}\nFrom: {msg['from']}\nTo: {msg['to']}"
+    if attachments:
+        header += f"\nAttachments: {', '.join(attachments)}"
+    return f"{header}\n\n{text}"
 
 
 def is_url(path: str) -> bool:
@@ -136,79 +363,216 @@ def is_url(path: str) -> bool:
 
 
 def extract_webpage(url: str) -> str:
+    response = requests.get(url)
+    response.raise_for_status()
+    soup = BeautifulSoup(response.content, "html.parser")
+
+    for script in soup(["script", "style"]):
+        script.decompose()
+
+    text = soup.get_text()
+
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    text = "\n".join(chunk for chunk in chunks if chunk)
+
+    return text
+
+
+def extract_unknown(source: Source) -> str:
+    from scanner import SNIFF_SIZE, sniff_head  # scanner imports this module
+
+    chunks = iter_chunks(source)
+    head = next(chunks, b"")
+    encoding = None
+    if sniff_head(bytes(head[:SNIFF_SIZE])) is None:
+        encoding = detect_encoding(head)
+    if encoding is None or encoding.lower() == "ascii":
+        # Binary or undetected: undecodable bytes become U+FFFD and count as garbage.
+        # ASCII heads fall through too, as UTF-8 may still follow them.
+        encoding = "utf-8"
+    return join_limited(iter_decoded(chain([head], chunks), encoding, "replace")).strip()
+
+
+def extract_mobi(source: Source) -> str:
+    with local_path(source, ".mobi") as file_path:
+        tempdir, extracted_path = mobi_extract(file_path)
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.content, "html.parser")
+        if extracted_path.endswith(".epub"):
+            return extract_epub(extracted_path)
+        if extracted_path.endswith(".pdf"):
+            return extract_pdf(extracted_path)
+        with open(extracted_path, "r", encoding="utf-8", errors="ignore") as file:
+            return html2text.html2text(file.read())
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def extract_pdf_pymupdf(source: Source) -> str:
+    if isinstance(source, str):
+        doc = fitz.open(source)
+    else:
+        doc = fitz.open(stream=source.read(), filetype="pdf")
+    with doc:
+        return "\n".join(page.get_text() for page in doc)
+
+
+def extract_xls_xlrd(source: Source) -> str:
+    if isinstance(source, str):
+        wb = xlrd.open_workbook(source)
+    else:
+        wb = xlrd.open_workbook(file_contents=source.read())
+    return "\n".join(
+        str(value)
+        for sheet in wb.sheets()
+        for row in range(sheet.nrows)
+        for value in sheet.row_values(row)
+        if value
+    )
+
+
+def command_extractor(command: str) -> Callable[[Source], str]:
+    # Legacy binary formats are handled by catdoc/antiword-style converters
+    def extract(source: Source) -> str:
+        with local_path(source) as file_path:
+            result = subprocess.run(
+                [command, file_path], capture_output=True, check=True
+            )
+        return result.stdout.decode("utf-8", errors="ignore")
+
+    extract.__name__ = f"extract_with_{command}"
+    return extract
+
 
-        for script in soup(["script", "style"]):
-            script.decompose()
+# Extension -> {backend name: extractor}, in order of preference
+BACKENDS: Dict[str, Dict[str, Callable[[Source], str]]] = {}
+# Extension -> backend chosen for this run
+EXTRACTORS: Dict[str, Callable[[Source], str]] = {}
 
-        text = soup.get_text()
 
-        lines = (line.strip() for line in text.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        text = "\n".join(chunk for chunk in chunks if chunk)
+def register_extractor(
+    ext: str, extractor: Callable[[Source], str], backend: str = "default"
+):
+    ext = ext.lower() if ext.startswith(".") else f".{ext.lower()}"
+    BACKENDS.setdefault(ext, {})[backend] = extractor
 
-        return text
-    except requests.RequestException as e:
-        return f"Ошибка при получении веб-страницы: {str(e)}"
 
+def load_plugins():
+    # Each entry point resolves to a callable that receives register_extractor
+    for entry_point in entry_points(group=PLUGIN_GROUP):
+        try:
+            entry_point.load()(register_extractor)
+        except Exception as e:
+            print(f"Failed to load extractor plugin {entry_point.name}: {e}")
 
-def extract_unknown(file_path: str) -> str:
+
+def load_benchmarks() -> Dict:
     try:
-        with open(file_path, "r", encoding="utf-8", errors="ignore") as file:
-            content = file.read()
-        if content:
-            return content.strip()
+        with open(benchmark_file, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def select_backends():
+    """Pick the fastest measured backend per extension, else the preferred one."""
+    benchmarks = load_benchmarks()
+    EXTRACTORS.clear()
+    for ext, backends in BACKENDS.items():
+        measured = {
+            name: stats["mb_per_sec"]
+            for name, stats in benchmarks.get(ext, {}).items()
+            if name in backends and not stats.get("errors")
+        }
+        if measured:
+            EXTRACTORS[ext] = backends[max(measured, key=measured.get)]
         else:
-            text = extract_text_with_encoding(file_path)
-            if text is not None:
-                return text.strip()
-            else:
-                return "Не удалось извлечь текст из файла"
-    except Exception as e:
-        return f"Не удалось прочитать файл: {str(e)}"
-
-
-EXTRACTORS = {
-    ".docx": extract_docx,
-    ".doc": extract_docx,
-    ".xlsx": extract_xlsx,
-    ".xls": extract_xlsx,
-    ".pptx": extract_pptx,
-    ".ppt": extract_pptx,
-    ".pdf": extract_pdf,
-    ".odt": extract_opendocument,
-    ".ods": extract_opendocument,
-    ".odp": extract_opendocument,
-    ".txt": extract_text_with_encoding,
-    ".rtf": extract_text_with_encoding,
-    ".csv": extract_csv,
-    ".json": extract_json,
-    ".yml": extract_yaml,
-    ".yaml": extract_yaml,
-    ".md": extract_markdown,
-    ".html": extract_html,
-    ".htm": extract_html,
-    ".xml": extract_xml,
-    ".eml": extract_eml,
-    ".log": extract_text_with_encoding,
-    ".ini": extract_text_with_encoding,
-    ".epub": extract_epub,
-    ".fb2": extract_fb2,
-}
-
-
-def extract_text(path: str) -> str:
-    if is_url(path):
-        return extract_webpage(path)
-
-    _, ext = os.path.splitext(path)
-    ext = ext.lower()
-
+            EXTRACTORS[ext] = next(iter(backends.values()))
+
+
+if fitz is not None:
+    register_extractor(".pdf", extract_pdf_pymupdf, "pymupdf")
+register_extractor(".pdf", extract_pdf, "pypdf2")
+register_extractor(".docx", extract_docx)
+register_extractor(".xlsx", extract_xlsx)
+register_extractor(".pptx", extract_pptx)
+register_extractor(".odt", extract_opendocument)
+register_extractor(".ods", extract_opendocument)
+register_extractor(".odp", extract_opendocument)
+register_extractor(".txt", extract_text_with_encoding)
+register_extractor(".rtf", extract_text_with_encoding)
+register_extractor(".csv", extract_csv)
+register_extractor(".json", extract_json)
+register_extractor(".jsonl", extract_json)
+register_extractor(".ndjson", extract_json)
+register_extractor(".yml", extract_yaml)
+register_extractor(".yaml", extract_yaml)
+register_extractor(".md", extract_markdown)
+register_extractor(".html", extract_html)
+register_extractor(".htm", extract_html)
+register_extractor(".xml", extract_xml)
+register_extractor(".eml", extract_eml)
+register_extractor(".log", extract_text_with_encoding)
+register_extractor(".ini", extract_text_with_encoding)
+register_extractor(".epub", extract_epub)
+register_extractor(".fb2", extract_fb2)
+register_extractor(".mobi", extract_mobi)
+register_extractor(".azw", extract_mobi)
+register_extractor(".azw3", extract_mobi)
+# Legacy binary Office formats only get a backend when a converter is available
+for command in ("antiword", "catdoc"):
+    if shutil.which(command):
+        register_extractor(".doc", command_extractor(command), command)
+if xlrd is not None:
+    register_extractor(".xls", extract_xls_xlrd, "xlrd")
+if shutil.which("catppt"):
+    register_extractor(".ppt", command_extractor("catppt"), "catppt")
+
+load_plugins()
+select_backends()
+
+
+@dataclass
+class ExtractionResult:
+    """Extracted text and whether it is worth sending to the language model."""
+
+    status: str  # "ok", "empty", "garbage" or "error"
+    text: str = field(default="", repr=False)
+    char_count: int = 0
+    garbage_score: float = 0.0
+    error: str | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status == "ok"
+
+
+def garbage_score(text: str) -> float:
+    """Share of characters that are not readable text, estimated from the start."""
+    sample = text[:GARBAGE_SAMPLE_CHARS]
+    if not sample:
+        return 0.0
+    return len(GARBAGE_PATTERN.findall(sample)) / len(sample)
+
+
+def extract_text(path: str, source: IO[bytes] | None = None) -> ExtractionResult:
+    """Extract text from a path or URL; `source` supplies the bytes for virtual paths."""
     try:
-        extractor = EXTRACTORS.get(ext, extract_unknown)
-        return extractor(path)
+        if source is None and is_url(path):
+            text = extract_webpage(path)
+        else:
+            _, ext = os.path.splitext(path)
+            extractor = EXTRACTORS.get(ext.lower(), extract_unknown)
+            text = extractor(path if source is None else source)
     except Exception as e:
-        return f"Ошибка при обработке файла: {str(e)}"
+        return ExtractionResult("error", error=str(e) or type(e).__name__)
+
+    text = (text or "").strip()
+    score = garbage_score(text)
+    if not text:
+        status = "empty"
+    elif score > max_garbage_score:
+        status = "garbage"
+    else:
+        status = "ok"
+    return ExtractionResult(status, text, len(text), score)
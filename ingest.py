@@ -0,0 +1,409 @@
+"""Asyncio API for adding files, directories and URLs to the library.
+
+    async with Ingestor() as ingestor:
+        async for result in ingestor.iter_ingest("/path/to/docs"):
+            ...
+
+    results = await ingest("/path/to/report.pdf")
+
+Language model calls go through aiohttp, extraction and database reads run in
+a thread pool, and database writes go through one writer thread per shard.
+Cancelling the consuming task, or closing the iterator after leaving the
+`async for` early (for example with `contextlib.aclosing`), cancels the work
+still in flight.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List
+
+import aiohttp
+
+from archives import iter_documents, outer_path
+from config import triage_model, triage_max_chars
+import database
+from database import add_file_to_db, get_all_tags, list_provisional_files, update_file_meta
+from extractor import ExtractionResult, extract_text, is_url
+from processor import LLM_TIMEOUT, analysis_steps, chat_request, count_metric, pool
+from scanner import scan_directory
+from scheduler import heuristic_meta, prioritize
+
+# Documents extracted ahead of the one being analyzed, per file
+PREFETCH = 1
+
+
+@dataclass
+class IngestResult:
+    """Outcome for one document: a file, an archive member or a URL."""
+
+    path: str
+    status: str  # "added", "refined", "skipped" or "failed"
+    file_id: int | None = None
+    meta: Dict | None = None
+    extraction: ExtractionResult | None = None
+    error: str | None = None
+
+
+class ShardWriters:
+    """One writer thread per shard: sqlite allows one writer at a time per database.
+
+    Share one instance between ingestion sessions and other writers (as
+    `un serve` does) to serialize all of a process's writes per shard.
+    """
+
+    def __init__(self):
+        self.executors = [ThreadPoolExecutor(max_workers=1) for _ in range(database.SHARDS)]
+        self._exclusive_lock = threading.Lock()
+
+    def submit(self, shard: int, func, *args) -> Future:
+        return self.executors[shard].submit(func, *args)
+
+    def exclusive(self, func, *args):
+        """Run func(*args) in this thread while every shard writer waits, for cross-shard writes."""
+        # One at a time: two callers each holding some writers would wait on each other
+        with self._exclusive_lock:
+            held = threading.Barrier(len(self.executors) + 1)
+            done = threading.Event()
+
+            def hold():
+                held.wait()
+                done.wait()
+
+            for executor in self.executors:
+                executor.submit(hold)
+            held.wait()
+            try:
+                return func(*args)
+            finally:
+                done.set()
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+
+
+@dataclass
+class _Done:
+    error: Exception | None = None
+    skipped: Counter | None = None
+
+
+class Ingestor:
+    """One ingestion session: an HTTP session, worker threads and the database writers.
+
+    Pass `writers` to share them with other sessions; otherwise the session has its own.
+    """
+
+    def __init__(self, writers: ShardWriters | None = None):
+        self.skipped = Counter()  # files and archive members skipped before extraction, by reason
+        self._session: aiohttp.ClientSession | None = None
+        self._executor = ThreadPoolExecutor(max_workers=pool.capacity * 2 + 2)
+        self._owns_writers = writers is None
+        self._writers = ShardWriters() if writers is None else writers
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=LLM_TIMEOUT))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        if self._owns_writers:
+            self._writers.shutdown()
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _write(self, shard: int, func, *args):
+        return asyncio.wrap_future(self._writers.submit(shard, func, *args))
+
+    # Language model
+
+    async def _acquire(self, tried):
+        future = self._run(pool.acquire, tuple(tried))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The blocking acquire still completes in its thread; hand the slot back then
+            future.add_done_callback(
+                lambda f: f.cancelled() or f.exception() or pool.abandon(f.result())
+            )
+            raise
+
+    async def _post(self, backend, body: Dict) -> str:
+        count_metric("llm_calls")
+        async with self._session.post(f"{backend.host}/api/chat", json=body) as response:
+            response.raise_for_status()
+            return (await response.json())["message"]["content"]
+
+    async def chat(self, messages: List[Dict], schema: Dict, model: str | None = None) -> str:
+        """One chat call, moved to another backend if one fails."""
+        tried, last_error = [], None
+        while True:
+            try:
+                backend = await self._acquire(tried)
+            except RuntimeError:
+                if tried:
+                    raise RuntimeError(f"All language model backends failed: {last_error}")
+                raise
+            start = time.monotonic()
+            try:
+                body = chat_request(messages, schema, model or backend.model)
+                raw = await self._post(backend, body)
+            except asyncio.CancelledError:
+                pool.abandon(backend)
+                raise
+            except Exception as e:
+                pool.release(backend, None)
+                tried.append(backend)
+                last_error = e
+                continue
+            pool.release(backend, time.monotonic() - start)
+            return raw
+
+    async def analyze(self, text: str, model: str | None = None) -> Dict | None:
+        """Title, summary and tags for a text, or None if the model never answers validly."""
+        steps = analysis_steps(text, await self._run(get_all_tags))
+        try:
+            messages, schema = next(steps)
+            while True:
+                messages, schema = steps.send(await self.chat(messages, schema, model))
+        except StopIteration as stop:
+            return stop.value
+
+    async def _triage(self, path: str, text: str) -> Dict:
+        file_meta = None
+        if triage_model:
+            try:
+                file_meta = await self.analyze(text[:triage_max_chars], triage_model)
+            except Exception:
+                pass
+        if file_meta is None:
+            file_meta = heuristic_meta(path, text)
+        file_meta["provisional"] = True
+        return file_meta
+
+    # Extraction
+
+    async def _extract_documents(self, path: str) -> AsyncIterator:
+        """Yield (document path, ExtractionResult) for a file and everything inside it.
+
+        Archive members have to be read in order from one open archive, so a
+        worker thread walks the file and hands results over through a queue.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        credits = threading.Semaphore(PREFETCH + 1)
+        stop = threading.Event()
+
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                pass  # the loop is gone
+
+        def produce():
+            error = None
+            skipped = Counter()
+            try:
+                for document_path, source in iter_documents(path, skipped=skipped):
+                    credits.acquire()
+                    if stop.is_set():
+                        return
+                    put((document_path, extract_text(document_path, source)))
+            except Exception as e:
+                error = e
+            finally:
+                put(_Done(error, skipped))
+
+        self._executor.submit(produce)
+        try:
+            while not isinstance(item := await queue.get(), _Done):
+                count_metric(f"extraction_{item[1].status}")
+                yield item
+                credits.release()
+            self.skipped.update(item.skipped)
+            if item.error is not None:
+                raise item.error
+        finally:
+            stop.set()
+            credits.release()
+
+    # Ingestion
+
+    async def _ingest_document(
+        self, path: str, extraction: ExtractionResult, triage: bool
+    ) -> IngestResult:
+        if extraction.status == "error":
+            return IngestResult(path, "skipped", extraction=extraction, error=extraction.error)
+        try:
+            if not extraction.ok:
+                # Empty or unreadable text is not worth a model call: describe it by name
+                file_meta = heuristic_meta(path, "")
+            elif triage:
+                file_meta = await self._triage(path, extraction.text)
+            else:
+                file_meta = await self.analyze(extraction.text)
+            if file_meta is None:
+                return IngestResult(
+                    path,
+                    "failed",
+                    extraction=extraction,
+                    error="No valid response from the language model after several attempts",
+                )
+            file_meta["path"] = path
+            if is_url(path):
+                file_meta["file_type"] = "website"
+            else:
+                file_meta["file_type"] = path.split("/")[-1].split(".")[-1]
+            shard = database.shard_for_path(path)
+            file_id = await self._write(shard, add_file_to_db, file_meta)
+            return IngestResult(path, "added", file_id, file_meta, extraction)
+        except Exception as e:
+            return IngestResult(path, "failed", extraction=extraction, error=str(e))
+
+    async def _ingest_file(self, path: str, triage: bool) -> AsyncIterator[IngestResult]:
+        # Archives and emails expand into their members, plain files into themselves
+        try:
+            async with aclosing(self._extract_documents(path)) as documents:
+                async for document_path, extraction in documents:
+                    yield await self._ingest_document(document_path, extraction, triage)
+        except Exception as e:
+            yield IngestResult(path, "failed", error=f"Stopped unpacking: {e}")
+
+    async def _ingest_url(self, url: str) -> IngestResult:
+        extraction = await self._run(extract_text, url)
+        count_metric(f"extraction_{extraction.status}")
+        return await self._ingest_document(url, extraction, triage=False)
+
+    async def _in_parallel(self, paths: List[str], handle) -> AsyncIterator[IngestResult]:
+        """Run handle(path) on as many paths as the backends have slots, yielding results."""
+        results = asyncio.Queue()
+        pending = iter(paths)
+
+        async def worker():
+            for path in pending:
+                # Close the handler's generators here, not later from the garbage collector
+                async with aclosing(handle(path)) as handled:
+                    async for result in handled:
+                        await results.put(result)
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(pool.capacity, len(paths)))]
+        for task in workers:
+            task.add_done_callback(lambda _: results.put_nowait(None))
+        try:
+            running = len(workers)
+            while running:
+                if (result := await results.get()) is None:
+                    running -= 1
+                else:
+                    yield result
+            for task in workers:
+                task.result()
+        finally:
+            for task in workers:
+                task.cancel()
+
+    async def iter_ingest(self, path: str, triage: bool = False) -> AsyncIterator[IngestResult]:
+        """Yield a result for every document in a file, directory or URL as it is stored.
+
+        With `triage`, documents first get provisional metadata and are then
+        refined by the main model, yielding a second "refined" result each.
+        """
+        if is_url(path):
+            yield await self._ingest_url(path)
+            return
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            files = await self._run(lambda: prioritize(list(scan_directory(path, self.skipped))))
+        elif os.path.isfile(path):
+            files = [path]
+        else:
+            raise ValueError(f"The input path {path} is neither a file nor a directory.")
+
+        handle = lambda file: self._ingest_file(file, triage)  # noqa: E731
+        async with aclosing(self._in_parallel(files, handle)) as results:
+            async for result in results:
+                yield result
+        # Everything is searchable now; spend the expensive model on refinement
+        if triage:
+            async with aclosing(self.iter_refine()) as results:
+                async for result in results:
+                    yield result
+
+    async def ingest(self, path: str, triage: bool = False) -> List[IngestResult]:
+        return [result async for result in self.iter_ingest(path, triage)]
+
+    # Refinement of provisional entries
+
+    async def _refine_file(self, path: str, file_ids: Dict[str, int]) -> AsyncIterator:
+        try:
+            async with aclosing(self._extract_documents(path)) as documents:
+                async for document_path, extraction in documents:
+                    file_id = file_ids.get(document_path)
+                    if file_id is None:
+                        continue
+                    yield await self._refine_document(document_path, file_id, extraction)
+        except Exception as e:
+            yield IngestResult(path, "failed", error=f"Could not refine: {e}")
+
+    async def _refine_document(
+        self, path: str, file_id: int, extraction: ExtractionResult
+    ) -> IngestResult:
+        if extraction.status == "error":
+            return IngestResult(
+                path, "skipped", file_id, extraction=extraction, error=extraction.error
+            )
+        try:
+            if extraction.ok:
+                file_meta = await self.analyze(extraction.text)
+            else:
+                file_meta = heuristic_meta(path, "")
+            if file_meta is None:
+                return IngestResult(
+                    path,
+                    "failed",
+                    file_id,
+                    extraction=extraction,
+                    error="No valid response from the language model, keeping provisional data",
+                )
+            shard, _ = database.split_id(file_id)
+            await self._write(shard, update_file_meta, file_id, file_meta)
+            return IngestResult(path, "refined", file_id, file_meta, extraction)
+        except Exception as e:
+            return IngestResult(path, "failed", file_id, extraction=extraction, error=str(e))
+
+    async def iter_refine(self) -> AsyncIterator[IngestResult]:
+        """Replace provisional metadata with a full analysis, in priority order."""
+        by_outer = {}
+        for row in await self._run(list_provisional_files):
+            by_outer.setdefault(outer_path(row["path"]), {})[row["path"]] = row["id"]
+        paths = await self._run(prioritize, list(by_outer))
+        handle = lambda path: self._refine_file(path, by_outer[path])  # noqa: E731
+        async with aclosing(self._in_parallel(paths, handle)) as results:
+            async for result in results:
+                yield result
+
+
+async def iter_ingest(path: str, triage: bool = False) -> AsyncIterator[IngestResult]:
+    async with Ingestor() as ingestor, aclosing(ingestor.iter_ingest(path, triage)) as results:
+        async for result in results:
+            yield result
+
+
+async def ingest(
+    path: str, triage: bool = False, writers: ShardWriters | None = None
+) -> List[IngestResult]:
+    async with Ingestor(writers) as ingestor:
+        return await ingestor.ingest(path, triage)
+
+
+async def refine() -> List[IngestResult]:
+    async with Ingestor() as ingestor:
+        return [result async for result in ingestor.iter_refine()]
@@ -0,0 +1,252 @@
+"""Synthetic large libraries and query-latency SLO checks for database.py.
+
+    python loadgen.py generate --db big.db --files 1000000
+    python loadgen.py check --sizes 10000,100000,1000000 [--shards 4]
+
+`check` grows one synthetic library through the given sizes and, at each size,
+times the database.py queries against their budgets and inspects their query
+plans for full table scans. It exits with status 1 when any check fails.
+"""
+
+import argparse
+import os
+import random
+import re
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+import database
+
+TAG_VOCABULARY = 20000
+ZIPF_EXPONENT = 1.1
+TAGS_PER_FILE = (5, 20)  # as required by the analysis prompts
+FILE_TYPES = {"pdf": 30, "docx": 20, "txt": 15, "md": 10, "html": 8, "xlsx": 7,
+              "pptx": 5, "eml": 3, "epub": 2}
+WORDS = ("report budget research meeting invoice draft contract design review "
+         "summary roadmap analysis manual notes guide lecture paper thesis "
+         "proposal release policy letter plan").split()
+# Every title carries a project code, so searches match a realistic 0.1% of files
+PROJECT_CODES = 1000
+HISTORY_DAYS = 5 * 365
+BATCH_SIZE = 10000
+
+# Budgets in ms: fixed cost per shard plus cost per million files, checked against p95
+BUDGETS_MS = {
+    "search_files": (20, 1500),
+    "filter_by_tags (popular)": (20, 1200),
+    "filter_by_tags (rare)": (5, 20),
+    "list_files (last week)": (10, 50),
+    "get_stats": (5, 150),
+    "get_stats (file_type)": (5, 300),
+    "get_stats (tag)": (20, 3000),
+    "add_file_to_db": (50, 20),
+}
+# Extra ms per additional shard where tag vocabularies are merged across shards
+MERGE_MS = {"get_stats": 20, "get_stats (tag)": 20}
+# Queries that have to read everything by definition
+ALLOWED_SCANS = {
+    "search_files": "a leading-wildcard LIKE cannot use an index",
+    "get_stats": "aggregates the whole library",
+    "get_stats (file_type)": "aggregates the whole library",
+    "get_stats (tag)": "aggregates the whole library",
+}
+# Tables that only ever hold a single row
+SINGLE_ROW_TABLES = {"library_meta"}
+FULL_SCAN = re.compile(r"^SCAN (\w+)\b(?! USING (COVERING )?INDEX)")
+
+
+def tag_name(rank: int) -> str:
+    return f"tag{rank:05d}"
+
+
+def generate(db_path: str, total_files: int, seed: int = 0, shards: int = 1):
+    """Grow the library at db_path to total_files synthetic files, without the LLM.
+
+    With several shards, files are dealt out to them in turn.
+    """
+    database.DB_NAME = db_path
+    database.SHARDS = shards
+    database.create_tables()
+    rng = random.Random(seed)
+    conns = [sqlite3.connect(database.shard_path(shard)) for shard in range(shards)]
+    for conn in conns:
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.executemany(
+            "INSERT OR IGNORE INTO tags (id, name) VALUES (?, ?)",
+            ((rank, tag_name(rank)) for rank in range(1, TAG_VOCABULARY + 1)),
+        )
+    # Zipfian popularity: the tag of rank r is drawn with weight 1 / r^s
+    ranks = range(1, TAG_VOCABULARY + 1)
+    tag_weights = list(accumulate(1 / rank**ZIPF_EXPONENT for rank in ranks))
+    types, type_weights = zip(*FILE_TYPES.items())
+
+    existing = sum(conn.execute("SELECT COUNT(*) FROM files").fetchone()[0] for conn in conns)
+    # Rows inserted by add_file_to_db checks take ids too
+    next_ids = [conn.execute("SELECT IFNULL(MAX(id), 0) + 1 FROM files").fetchone()[0]
+                for conn in conns]
+    start = datetime.now() - timedelta(days=HISTORY_DAYS)
+    step = HISTORY_DAYS * 86400 / max(total_files, 1)
+
+    for batch_start in range(existing, total_files, BATCH_SIZE):
+        files, file_tags = [[] for _ in conns], [[] for _ in conns]
+        for number in range(batch_start + 1, min(batch_start + BATCH_SIZE, total_files) + 1):
+            shard = number % shards
+            file_id = next_ids[shard]
+            next_ids[shard] += 1
+            code = f"P{rng.randint(1, PROJECT_CODES):04d}"
+            title = " ".join([*rng.choices(WORDS, k=3), code])
+            summary = " ".join(rng.choices(WORDS, k=40))
+            file_type = rng.choices(types, type_weights)[0]
+            created_at = start + timedelta(seconds=number * step)
+            files[shard].append((file_id, title, summary, file_type,
+                                 f"/synthetic/{number}.{file_type}",
+                                 created_at.strftime("%Y-%m-%d %H:%M:%S")))
+            count = rng.randint(*TAGS_PER_FILE)
+            tags = set(rng.choices(ranks, cum_weights=tag_weights, k=count))
+            file_tags[shard].extend((file_id, tag_id) for tag_id in tags)
+        for conn, shard_files, shard_tags in zip(conns, files, file_tags):
+            conn.executemany(
+                "INSERT INTO files (id, title, summary, file_type, path, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                shard_files,
+            )
+            conn.executemany("INSERT INTO file_tags (file_id, tag_id) VALUES (?, ?)", shard_tags)
+            conn.commit()
+
+    for conn in conns:
+        conn.execute("ANALYZE")
+        conn.commit()
+        conn.close()
+
+
+def operations(rng: random.Random):
+    week_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+    return {
+        "search_files": lambda: database.search_files(
+            f"P{rng.randint(1, PROJECT_CODES):04d}"
+        ),
+        "filter_by_tags (popular)": lambda: database.filter_by_tags(
+            [tag_name(rng.randint(20, 50))]
+        ),
+        "filter_by_tags (rare)": lambda: database.filter_by_tags(
+            [tag_name(rng.randint(10000, TAG_VOCABULARY))]
+        ),
+        "list_files (last week)": lambda: database.list_files(week_ago),
+        "get_stats": lambda: database.get_stats(),
+        "get_stats (file_type)": lambda: database.get_stats("file_type"),
+        "get_stats (tag)": lambda: database.get_stats("tag"),
+        "add_file_to_db": lambda: database.add_file_to_db(
+            {
+                "title": "load test",
+                "summary": " ".join(rng.choices(WORDS, k=40)),
+                "file_type": "txt",
+                "path": "/synthetic/added.txt",
+                "tags": [tag_name(rng.randint(1, TAG_VOCABULARY)) for _ in range(10)],
+            }
+        ),
+    }
+
+
+def full_scans(db_path: str, statements) -> set:
+    # Shards share one schema, so the first one stands for all of them
+    conn = sqlite3.connect(db_path)
+    scans = set()
+    for statement in statements:
+        if not statement.lstrip().upper().startswith("SELECT"):
+            continue
+        materialized = set(SINGLE_ROW_TABLES)
+        for row in conn.execute(f"EXPLAIN QUERY PLAN {statement}"):
+            detail = row[3]
+            if detail.startswith("MATERIALIZE "):
+                materialized.add(detail.split()[1])
+            match = FULL_SCAN.match(detail)
+            if match and match.group(1) not in materialized:
+                scans.add(match.group(1))
+    conn.close()
+    return scans
+
+
+def check(db_path: str, size: int, repeat: int, shards: int = 1) -> list:
+    """Time every operation and inspect its plans; return a list of failures."""
+    rng = random.Random(size)
+    failures = []
+    print(f"\n{size:,} files")
+    print(f"{'operation':<28}{'p50 ms':>10}{'p95 ms':>10}{'budget':>10}  plan")
+    for name, operation in operations(rng).items():
+        statements = []
+        database.trace_statements(statements.append)
+        operation()
+        database.trace_statements(None)
+        scans = full_scans(db_path, statements)
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            operation()
+            timings.append((time.perf_counter() - start) * 1000)
+        p50 = statistics.median(timings)
+        p95 = statistics.quantiles(timings, n=20)[-1] if len(timings) > 1 else timings[0]
+        base, per_million = BUDGETS_MS[name]
+        budget = base * shards + MERGE_MS.get(name, 0) * (shards - 1)
+        budget += per_million * size / 1_000_000
+
+        plan = "ok"
+        if scans:
+            plan = f"full scan of {', '.join(sorted(scans))}"
+            if name in ALLOWED_SCANS:
+                plan += f" (allowed: {ALLOWED_SCANS[name]})"
+            else:
+                failures.append(f"{size:,} files: {name} does a {plan}")
+        if p95 > budget:
+            failures.append(f"{size:,} files: {name} p95 {p95:.1f} ms > {budget:.1f} ms")
+        print(f"{name:<28}{p50:>10.1f}{p95:>10.1f}{budget:>10.1f}  {plan}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="Fill a database with synthetic files")
+    generate_parser.add_argument("--db", required=True, help="Database to create or extend")
+    generate_parser.add_argument("--files", type=int, required=True, help="Total number of files")
+    generate_parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+    check_parser = subparsers.add_parser("check", help="Check latency budgets and query plans")
+    check_parser.add_argument(
+        "--sizes", default="10000,100000,1000000", help="Comma-separated library sizes"
+    )
+    check_parser.add_argument("--repeat", type=int, default=20, help="Timed runs per query")
+    check_parser.add_argument("--db", help="Database to grow (default: a temporary file)")
+    for subparser in (generate_parser, check_parser):
+        subparser.add_argument(
+            "--shards", type=int, default=1, help="Databases to split the library into"
+        )
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        generate(args.db, args.files, args.seed, args.shards)
+        print(f"{args.db} now holds {args.files:,} synthetic files")
+        return
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), "loadgen.db")
+    failures = []
+    for size in sorted(int(size) for size in args.sizes.split(",")):
+        generate(db_path, size, shards=args.shards)
+        failures.extend(check(db_path, size, args.repeat, args.shards))
+
+    if failures:
+        print("\nFailed checks:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("\nAll latency budgets and query plans are within limits.")
+
+
+if __name__ == "__main__":
+    main()
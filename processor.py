@@ -1,15 +1,46 @@
-from langchain_community.chat_models import ChatOllama
-from langchain_core.output_parsers import JsonOutputParser
-from pydantic import BaseModel, Field
-from typing import List
-from prompts import text_analyze_prompt_ru, text_analyze_prompt_en
-from langchain_core.exceptions import OutputParserException
-from config import model_name, ollama_host, temperature_value, attempts_number, language
-from database import get_all_tags, add_file_to_db
-from extractor import extract_text
-import os
+from langchain_core.utils.json import parse_partial_json
+from pydantic import BaseModel
+from typing import Dict, List, Tuple
+from prompts import (
+    text_analyze_prompt_ru,
+    text_analyze_prompt_en,
+    field_retry_prompt_ru,
+    field_retry_prompt_en,
+)
+from config import (
+    model_name,
+    ollama_host,
+    ollama_backends,
+    health_check_interval,
+    temperature_value,
+    attempts_number,
+    structured_output,
+    language,
+)
+from collections import Counter
+import ast
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
 
 text_analyze_prompt = text_analyze_prompt_en if language == "en" else text_analyze_prompt_ru
+field_retry_prompt = field_retry_prompt_en if language == "en" else field_retry_prompt_ru
+
+# Seconds one chat call may take before its backend counts as failed
+LLM_TIMEOUT = 600
+
+# Counters of language model round trips, reported after each run
+METRICS = Counter()
+_metrics_lock = threading.Lock()
+
+
+def count_metric(name: str):
+    with _metrics_lock:
+        METRICS[name] += 1
+
 
 class FileMeta(BaseModel):
     title: str
@@ -17,69 +48,259 @@ class FileMeta(BaseModel):
     tags: List[str]
 
 
-def analyze_text(text):
-    parser = JsonOutputParser(pydantic_object=FileMeta)
+FILE_META_SCHEMA = (
+    FileMeta.model_json_schema()
+    if hasattr(FileMeta, "model_json_schema")
+    else FileMeta.schema()
+)
+
+
+class Backend:
+    def __init__(self, host: str, model: str, max_concurrency: int = 1):
+        self.host = host
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.outstanding = 0
+        self.latency = None  # moving average of call duration, seconds
+        self.healthy = True
+        self.checked_at = 0.0
+        self.probing = False
+
+    def score(self) -> float:
+        # Expected wait if queued here: requests ahead of us times their cost
+        return (self.outstanding + 1) * (self.latency or 1.0)
+
+    def check_health(self) -> bool:
+        try:
+            return requests.get(f"{self.host}/api/tags", timeout=5).ok
+        except requests.RequestException:
+            return False
+
+
+class BackendPool:
+    """Schedules LLM calls over several Ollama servers by least expected wait."""
+
+    def __init__(self, backends: List[Backend]):
+        self.backends = backends
+        self.condition = threading.Condition()
+
+    @property
+    def capacity(self) -> int:
+        return sum(backend.max_concurrency for backend in self.backends)
+
+    def _claim_probes(self, exclude, force: bool = False) -> List[Backend]:
+        # Called with the lock held; the caller probes the claimed backends
+        now = time.monotonic()
+        due = [
+            backend
+            for backend in self.backends
+            if not backend.healthy
+            and not backend.probing
+            and backend not in exclude
+            and (force or now - backend.checked_at >= health_check_interval)
+        ]
+        for backend in due:
+            backend.probing = True
+        return due
+
+    def _probe(self, backends: List[Backend]):
+        # Health checks are HTTP calls, so they run in parallel and without the lock
+        with ThreadPoolExecutor(max_workers=len(backends)) as executor:
+            results = list(executor.map(Backend.check_health, backends))
+        with self.condition:
+            for backend, healthy in zip(backends, results):
+                backend.healthy = healthy
+                backend.checked_at = time.monotonic()
+                backend.probing = False
+            self.condition.notify_all()
+
+    def acquire(self, exclude=()) -> Backend:
+        probed_all = False
+        while True:
+            with self.condition:
+                due = self._claim_probes(exclude)
+                if not due:
+                    candidates = [
+                        backend
+                        for backend in self.backends
+                        if backend.healthy and backend not in exclude
+                    ]
+                    free = [b for b in candidates if b.outstanding < b.max_concurrency]
+                    if free:
+                        backend = min(free, key=Backend.score)
+                        backend.outstanding += 1
+                        return backend
+                    probing = any(b.probing and b not in exclude for b in self.backends)
+                    if not candidates and not probed_all:
+                        # All down: probe now instead of failing for a whole interval
+                        due = self._claim_probes(exclude, force=True)
+                        probed_all = True
+                    # Nothing left to probe or wait for, e.g. every backend is excluded
+                    if not candidates and not due and not probing:
+                        raise RuntimeError("No healthy language model backend available")
+                if not due:
+                    # Wait for a free slot, or for probes made by other workers
+                    self.condition.wait(timeout=health_check_interval)
+                    continue
+            self._probe(due)
+
+    def abandon(self, backend: Backend):
+        # The caller gave up (e.g. was cancelled): free the slot without judging the backend
+        with self.condition:
+            backend.outstanding -= 1
+            self.condition.notify_all()
+
+    def release(self, backend: Backend, elapsed: float | None):
+        with self.condition:
+            backend.outstanding -= 1
+            if elapsed is None:
+                backend.healthy = False
+                backend.checked_at = time.monotonic()
+            elif backend.latency is None:
+                backend.latency = elapsed
+            else:
+                backend.latency = 0.8 * backend.latency + 0.2 * elapsed
+            self.condition.notify_all()
+
+
+def create_pool() -> BackendPool:
+    if ollama_backends:
+        backends = [
+            Backend(
+                entry["host"],
+                entry.get("model", model_name),
+                entry.get("max_concurrency", 1),
+            )
+            for entry in ollama_backends
+        ]
+    else:
+        backends = [Backend(ollama_host, model_name)]
+    return BackendPool(backends)
+
+
+pool = create_pool()
+
+
+def repair_json(raw: str) -> Dict | None:
+    """Parse almost-valid JSON: fences, prose, trailing commas, truncation."""
+    raw = re.sub(r"^```(?:json)?|```$", "", raw.strip(), flags=re.MULTILINE).strip()
+    start, end = raw.find("{"), raw.rfind("}")
+    if start != -1:
+        raw = raw[start : end + 1] if end > start else raw[start:]
+    candidates = [raw, re.sub(r",\s*([}\]])", r"\1", raw)]
+    for candidate in candidates:
+        try:
+            data = json.loads(candidate)
+        except ValueError:
+            try:
+                data = ast.literal_eval(candidate)
+            except (ValueError, SyntaxError):
+                data = parse_partial_json(candidate)
+        if isinstance(data, dict):
+            return data
+    return None
+
+
+def validate_meta(data: Dict) -> Tuple[Dict, List[str]]:
+    """Split parsed output into usable fields and the names of invalid ones."""
+    valid = {}
+    for field in ("title", "summary"):
+        value = data.get(field)
+        if isinstance(value, str) and value.strip():
+            valid[field] = value.strip()
+
+    tags = data.get("tags")
+    if isinstance(tags, str):
+        tags = tags.split(",")
+    if isinstance(tags, list):
+        tags = [str(tag).strip() for tag in tags if str(tag).strip()]
+        if tags:
+            valid["tags"] = list(dict.fromkeys(tags))
+
+    invalid = [field for field in FILE_META_SCHEMA["properties"] if field not in valid]
+    return valid, invalid
+
 
-    llm = ChatOllama(
-        model=model_name, temperature=temperature_value, base_url=ollama_host
-    )
-    chain = text_analyze_prompt | llm | parser
+def partial_schema(fields: List[str]) -> Dict:
+    return {
+        "type": "object",
+        "properties": {f: FILE_META_SCHEMA["properties"][f] for f in fields},
+        "required": fields,
+    }
 
-    # Attempt analysis multiple times if parsing fails
-    for i in range(attempts_number):
+
+def to_ollama_messages(messages) -> List[Dict]:
+    roles = {"system": "system", "human": "user", "ai": "assistant"}
+    return [{"role": roles[m.type], "content": m.content} for m in messages]
+
+
+def chat_request(messages: List[Dict], schema: Dict, model: str) -> Dict:
+    return {
+        "model": model,
+        "messages": messages,
+        "stream": False,
+        # Schema-constrained decoding, or plain JSON mode for older servers
+        "format": schema if structured_output else "json",
+        "options": {"temperature": temperature_value},
+    }
+
+
+def analysis_steps(text: str, all_tags: List[str]):
+    """The analysis dialogue without I/O: yields (messages, schema), receives replies.
+
+    Returns the metadata dict, or None if all attempts fail. Driven by
+    Ingestor.analyze in ingest.py, which makes the calls.
+    """
+    prompt = text_analyze_prompt.format_messages(text=text, all_tags=", ".join(all_tags))
+    messages = to_ollama_messages(prompt)
+    meta, invalid = {}, list(FILE_META_SCHEMA["properties"])
+
+    # Ask again only for what is still missing, up to attempts_number calls
+    for attempt in range(attempts_number):
+        schema = FILE_META_SCHEMA if not meta else partial_schema(invalid)
+        raw = yield messages, schema
         try:
-            return chain.invoke({"text": text, "all_tags": get_all_tags})
-        except OutputParserException:
+            data = json.loads(raw)
+        except ValueError:
+            data = repair_json(raw)
+            if data is None:
+                count_metric("full_retries" if not meta else "field_retries")
+                continue
+            count_metric("json_repairs")
+        if not isinstance(data, dict):
+            count_metric("full_retries" if not meta else "field_retries")
             continue
 
+        valid, _ = validate_meta(data)
+        meta.update({field: valid[field] for field in invalid if field in valid})
+        invalid = [field for field in invalid if field not in meta]
+        if not invalid:
+            return meta
+
+        count_metric("field_retries")
+        retry = field_retry_prompt.format(fields=", ".join(invalid))
+        messages = messages + [
+            {"role": "assistant", "content": raw},
+            {"role": "user", "content": retry},
+        ]
+
     # Return None if all attempts fail
+    count_metric("failures")
     return None
 
 
-def process_file(path):
-    try:
-        # Extract text from file
-        extracted_text = extract_text(path)
-        # Analyze extracted text
-        file_meta = analyze_text(extracted_text)
-        print(f"\n{file_meta}\n")
-        # Check if language model returned a valid response
-        if file_meta is None:
-            raise RuntimeError(
-                "It was not possible to get a correct response from language model after several attempts"
-            )
-        # Add file metadata to database
-        file_meta["path"] = path
-        file_meta["file_type"] = path.split("/")[-1].split(".")[-1]
-        add_file_to_db(file_meta)
-        print(f"File metadata for {path} has been successfully added to database.")
-    except Exception as e:
-        print(f"An error occurred while processing file {path}: {e}")
-
-
-def process_url(url):
-    try:
-        # Extract text from URL
-        extracted_text = extract_text(url)
-        # Analyze extracted text
-        file_meta = analyze_text(extracted_text)
-        print(f"\n{file_meta}\n")
-        # Check if llm return valid response
-        if file_meta is None:
-            raise RuntimeError(
-                "It was not possible to get a correct response from language model after several attempts"
-            )
-        # Add URL metadata to database
-        file_meta["path"] = url
-        file_meta["file_type"] = "website"
-        add_file_to_db(file_meta)
-        print(f"URL metadata for {url} has been successfully added to database.")
-    except Exception as e:
-        print(f"An error occurred while processing URL {url}: {e}")
-
-
-def process_directory(directory):
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            file_path = os.path.join(root, file)
-            process_file(file_path)
+def report_metrics():
+    extraction = {
+        name.removeprefix("extraction_"): count
+        for name, count in METRICS.items()
+        if name.startswith("extraction_")
+    }
+    calls = {
+        name: count for name, count in METRICS.items() if not name.startswith("extraction_")
+    }
+    if extraction:
+        counts = ", ".join(f"{name}={count}" for name, count in sorted(extraction.items()))
+        print(f"Extracted documents: {counts}")
+    if calls:
+        counts = ", ".join(f"{name}={count}" for name, count in sorted(calls.items()))
+        print(f"Language model calls: {counts}")
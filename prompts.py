@@ -102,3 +102,10 @@ text_analyze_prompt_en = ChatPromptTemplate.from_messages(
         ),
     ]
 )
+
+
+field_retry_prompt_ru = """В вашем ответе отсутствуют или некорректны поля: {fields}.
+Верните СТРОГО JSON только с этими полями, на РУССКОМ ЯЗЫКЕ."""
+
+field_retry_prompt_en = """Your answer is missing or has invalid fields: {fields}.
+Return STRICTLY a JSON object with only these fields, IN ENGLISH."""
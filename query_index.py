@@ -0,0 +1,589 @@
+import bisect
+import os
+import json
+import sys
+import re
+import threading
+from array import array
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+import database
+from config import query_index_file
+
+# A tag is kept as a bitmap once its postings would take more room than one
+DENSE_RATIO = 32
+BITMAP_CACHE_SIZE = 512
+# Bumped whenever the layout written by save_index changes
+SNAPSHOT_VERSION = 1
+TOKEN_PATTERN = re.compile(r'\s*(\(|\)|,|"[^"]*"|[^\s(),]+)')
+OPERATORS = {"AND", "OR", "NOT"}
+
+
+class QueryError(ValueError):
+    pass
+
+
+def is_tag_expression(tags: str) -> bool:
+    """Tell boolean tag expressions apart from plain comma-separated tag lists."""
+    return bool(re.search(r"[()\"]|\b(AND|OR|NOT)\b", tags))
+
+
+def to_expression(tags: str) -> str:
+    if is_tag_expression(tags):
+        return tags
+    # Plain comma lists may contain spaces, so quote every tag
+    return " OR ".join(f'"{tag}"' for tag in tags.split(",") if tag)
+
+
+def parse_expression(expression: str):
+    """Parse a tag expression into nested ("and", a, b), ("not", a), ("tag", name) tuples."""
+    tokens = TOKEN_PATTERN.findall(expression)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def parse_or():
+        node = parse_and()
+        while peek() in ("OR", ","):
+            take()
+            node = ("or", node, parse_and())
+        return node
+
+    def parse_and():
+        node = parse_not()
+        while peek() == "AND":
+            take()
+            node = ("and", node, parse_not())
+        return node
+
+    def parse_not():
+        if peek() == "NOT":
+            take()
+            return ("not", parse_not())
+        if peek() == "(":
+            take()
+            node = parse_or()
+            if peek() != ")":
+                raise QueryError("Missing closing parenthesis")
+            take()
+            return node
+        token = peek()
+        if token is None or token in OPERATORS or token in ("(", ")", ","):
+            raise QueryError(f"Expected a tag, got {token or 'end of query'}")
+        return ("tag", take().strip('"'))
+
+    if not tokens:
+        return None
+    tree = parse_or()
+    if peek() is not None:
+        raise QueryError(f"Unexpected {peek()}")
+    return tree
+
+
+def _condition(node) -> Tuple[str, List]:
+    # The expression as SQL on files f, for answering without the index
+    kind = node[0]
+    if kind == "tag":
+        return (
+            "f.id IN (SELECT file_id FROM file_tags"
+            " WHERE tag_id = (SELECT id FROM tags WHERE name = ?))",
+            [node[1]],
+        )
+    if kind == "not":
+        condition, params = _condition(node[1])
+        return f"NOT ({condition})", params
+    left, left_params = _condition(node[1])
+    right, right_params = _condition(node[2])
+    return f"({left} {kind.upper()} {right})", left_params + right_params
+
+
+def _ids_to_bits(ids) -> int:
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for file_id in ids:
+        buffer[file_id >> 3] |= 1 << (file_id & 7)
+    return int.from_bytes(buffer, "little")
+
+
+def _bits_to_ids(bits: int) -> List[int]:
+    ids = []
+    digits = bin(bits)[:1:-1]  # least significant bit first
+    position = digits.find("1")
+    while position != -1:
+        ids.append(position)
+        position = digits.find("1", position + 1)
+    return ids
+
+
+class Postings:
+    """File ids for one tag, file type or month: a sorted array or a bitmap."""
+
+    def __init__(self, ids=()):
+        self.ids = array("q", sorted(ids))
+        self.bits = None
+
+    def __len__(self):
+        return len(self.ids) if self.bits is None else self.bits.bit_count()
+
+    def add(self, file_id: int):
+        if self.bits is not None:
+            self.bits |= 1 << file_id
+            return
+        if not self.ids or self.ids[-1] < file_id:
+            self.ids.append(file_id)
+        else:
+            position = bisect.bisect_left(self.ids, file_id)
+            if position == len(self.ids) or self.ids[position] != file_id:
+                self.ids.insert(position, file_id)
+
+    def remove(self, file_id: int) -> bool:
+        if self.bits is not None:
+            present = bool(self.bits >> file_id & 1)
+            self.bits &= ~(1 << file_id)
+            return present
+        position = bisect.bisect_left(self.ids, file_id)
+        if position < len(self.ids) and self.ids[position] == file_id:
+            del self.ids[position]
+            return True
+        return False
+
+    def compact(self, max_id: int):
+        if self.bits is None and len(self.ids) * DENSE_RATIO >= max_id:
+            self.bits = _ids_to_bits(self.ids)
+            self.ids = array("q")
+
+
+def _postings(group: Dict[str, Postings], key: str) -> Postings:
+    postings = group.get(key)
+    if postings is None:
+        postings = group[key] = Postings()
+    return postings
+
+
+class QueryIndex:
+    """Columnar view of files/file_tags answering tag expressions and range filters."""
+
+    # Everything but locks and caches: what a rebuild swaps in and a snapshot stores
+    FIELDS = ("generations", "max_id", "universe", "tags", "file_types", "months", "created")
+
+    def __init__(self):
+        # Generation of each shard; their number also tells how file ids were built
+        self.generations = None
+        self.max_id = 0
+        self.universe = 0
+        self.tags: Dict[str, Postings] = {}
+        self.file_types: Dict[str, Postings] = {}
+        self.months: Dict[str, Postings] = {}
+        # (created_at, id) pairs sorted by time, for the partial months of a range
+        self.created = []
+        self.lock = threading.RLock()
+        # Serializes rebuilds, which run without holding `lock`
+        self.rebuild_lock = threading.Lock()
+        self.cache = OrderedDict()
+
+    # Building
+
+    def build(self):
+        self.generations = []
+        # Ids are collected per key first: growing big integers or sorted arrays
+        # one row at a time would cost time quadratic in the library size
+        ids = []
+        tags, file_types, months = defaultdict(list), defaultdict(list), defaultdict(list)
+        for shard in range(database.SHARDS):
+            with database.get_connection(shard) as conn:
+                cursor = conn.cursor()
+                # One read transaction, so the generation matches the rows read
+                cursor.execute("BEGIN")
+                self.generations.append(database.read_generation(cursor))
+                cursor.execute("SELECT id, file_type, created_at FROM files")
+                for local_id, file_type, created_at in cursor:
+                    file_id = database.global_id(local_id, shard)
+                    created_at = created_at or ""
+                    ids.append(file_id)
+                    file_types[file_type or ""].append(file_id)
+                    months[created_at[:7]].append(file_id)
+                    self.created.append((created_at, file_id))
+                # One row per tag rather than per file_tags row: row objects dominate
+                cursor.execute(
+                    """
+                    SELECT t.name, postings.file_ids
+                    FROM (
+                        SELECT tag_id, GROUP_CONCAT(file_id) AS file_ids
+                        FROM file_tags
+                        GROUP BY tag_id
+                    ) postings
+                    JOIN tags t ON t.id = postings.tag_id
+                    """
+                )
+                shards = database.SHARDS
+                for name, file_ids in cursor:
+                    local_ids = map(int, file_ids.split(","))
+                    if shards > 1:
+                        # database.global_id, inlined for millions of ids
+                        local_ids = (local_id * shards + shard for local_id in local_ids)
+                    tags[name].extend(local_ids)
+        self.max_id = max(ids, default=0)
+        self.universe = _ids_to_bits(ids)
+        self.tags = {name: Postings(members) for name, members in tags.items()}
+        self.file_types = {key: Postings(members) for key, members in file_types.items()}
+        self.months = {key: Postings(members) for key, members in months.items()}
+        self.created.sort()
+        self._compact()
+
+    def _add_file(self, file_id: int, file_type: str | None, created_at: str):
+        self.max_id = max(self.max_id, file_id)
+        self.universe |= 1 << file_id
+        _postings(self.file_types, file_type or "").add(file_id)
+        _postings(self.months, created_at[:7]).add(file_id)
+        self.created.append((created_at, file_id))
+
+    def refresh(self):
+        """Rebuild from the database unless the index is already current."""
+        with self.rebuild_lock:
+            if database.get_generations() == self.generations:
+                return
+            # Built aside and swapped in, so queries never see a half-built index
+            fresh = QueryIndex()
+            fresh.build()
+            with self.lock:
+                for name in self.FIELDS:
+                    setattr(self, name, getattr(fresh, name))
+                self.cache.clear()
+
+    def refresh_later(self):
+        """Start refresh() in the background unless a rebuild is already running."""
+        if not self.rebuild_lock.locked():
+            threading.Thread(target=self.refresh, daemon=True).start()
+
+    def _compact(self):
+        for group in (self.tags, self.file_types, self.months):
+            for postings in group.values():
+                postings.compact(self.max_id)
+        self.cache.clear()
+
+    # Incremental maintenance, driven by database change events
+
+    def apply(self, event: str, **data):
+        if event == "reset":
+            with self.lock:
+                # Matches no database, so the index counts as stale until rebuilt
+                self.generations = None
+            self.refresh_later()
+            return
+        generations = data["generations"]
+        with self.lock:
+            known = self.generations
+            if known is None:
+                return  # a rebuild is pending and will read this write
+            if all(generation <= known[shard] for shard, generation in generations.items()):
+                return  # already read by a rebuild
+            # Any other step means another process wrote in between
+            if any(generation != known[shard] + 1 for shard, generation in generations.items()):
+                missed = True
+            else:
+                missed = False
+                # Only what the write touched: a full _compact() walks every tag
+                for kind, key in self._apply(event, data):
+                    self.cache.pop((kind, key), None)
+                    postings = self._group(kind).get(key)
+                    if postings is not None:
+                        postings.compact(self.max_id)
+                for shard, generation in generations.items():
+                    known[shard] = generation
+        if missed:
+            self.refresh_later()
+
+    def _group(self, kind: str) -> Dict[str, Postings]:
+        return {"tag": self.tags, "type": self.file_types, "month": self.months}[kind]
+
+    def _apply(self, event: str, data: Dict) -> List[Tuple[str, str]]:
+        """Apply one write and return the (kind, key) of every postings list it changed."""
+        if event == "add_file":
+            file_id = data["file_id"]
+            created_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+            self._add_file(file_id, data["file_type"], created_at)
+            for tag in data["tags"]:
+                _postings(self.tags, tag).add(file_id)
+            touched = [("type", data["file_type"] or ""), ("month", created_at[:7])]
+            return touched + [("tag", tag) for tag in data["tags"]]
+        if event == "add_tag":
+            _postings(self.tags, data["tag"]).add(data["file_id"])
+            return [("tag", data["tag"])]
+        if event == "set_tags":
+            file_id = data["file_id"]
+            # Without the old tags in the event, every tag is checked; only hits are touched
+            touched = [
+                ("tag", tag) for tag, postings in self.tags.items() if postings.remove(file_id)
+            ]
+            for tag in data["tags"]:
+                _postings(self.tags, tag).add(file_id)
+            return touched + [("tag", tag) for tag in data["tags"]]
+        if event == "rename_tag":
+            postings = self.tags.pop(data["old_name"], None)
+            if postings is not None:
+                target = self.tags.get(data["new_name"])
+                self.tags[data["new_name"]] = postings
+                if target is not None:
+                    for file_id in self._ids(target):
+                        postings.add(file_id)
+            return [("tag", data["old_name"]), ("tag", data["new_name"])]
+        return []
+
+    # Querying
+
+    def _ids(self, postings: Postings) -> List[int]:
+        if postings.bits is None:
+            return list(postings.ids)
+        return _bits_to_ids(postings.bits)
+
+    def _bits(self, key, postings: Postings | None) -> int:
+        if postings is None:
+            return 0
+        if postings.bits is not None:
+            return postings.bits
+        # Sparse postings are turned into bitmaps on demand and kept for a while
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        bits = _ids_to_bits(postings.ids)
+        self.cache[key] = bits
+        if len(self.cache) > BITMAP_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return bits
+
+    def _date_bits(self, date_after: str | None, date_before: str | None) -> int:
+        low, high = date_after or "", date_before or "\uffff"
+        bits = 0
+        for month, postings in self.months.items():
+            if low[:7] < month < high[:7]:
+                bits |= self._bits(("month", month), postings)
+        # Months at the edges of the range are filtered by exact timestamps
+        edges = {date[:7] for date in (date_after, date_before) if date}
+        for month in edges & self.months.keys():
+            start = bisect.bisect_right(self.created, (max(low, month), float("inf")))
+            end = bisect.bisect_left(self.created, (min(high, month + "\uffff"), -1))
+            bits |= _ids_to_bits([file_id for _, file_id in self.created[start:end]])
+        return bits
+
+    def _evaluate(self, node) -> int:
+        kind = node[0]
+        if kind == "tag":
+            return self._bits(("tag", node[1]), self.tags.get(node[1]))
+        if kind == "not":
+            return self.universe & ~self._evaluate(node[1])
+        left, right = self._evaluate(node[1]), self._evaluate(node[2])
+        return left & right if kind == "and" else left | right
+
+    def query(
+        self,
+        expression: str = "",
+        file_types: List[str] | None = None,
+        date_after: str | None = None,
+        date_before: str | None = None,
+    ) -> List[int]:
+        """Return ids of files matching a tag expression like `a AND (b OR NOT c)`."""
+        tree = parse_expression(expression)
+        with self.lock:
+            bits = self.universe if tree is None else self._evaluate(tree)
+            if file_types:
+                type_bits = 0
+                for file_type in file_types:
+                    postings = self.file_types.get(file_type)
+                    type_bits |= self._bits(("type", file_type), postings)
+                bits &= type_bits
+            if date_after or date_before:
+                bits &= self._date_bits(date_after, date_before)
+        return _bits_to_ids(bits)
+
+
+_index: QueryIndex | None = None
+_index_lock = threading.Lock()
+
+
+def _bits_to_bytes(bits: int) -> bytes:
+    return bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+
+
+def _dump_group(group: Dict[str, Postings], sections: List[bytes]) -> List:
+    entries = []
+    for key, postings in group.items():
+        if postings.bits is None:
+            data, kind = postings.ids.tobytes(), "ids"
+        else:
+            data, kind = _bits_to_bytes(postings.bits), "bits"
+        entries.append([key, kind, len(data)])
+        sections.append(data)
+    return entries
+
+
+def _read_section(file, size: int) -> bytes:
+    data = file.read(size)
+    if len(data) != size:
+        raise ValueError("truncated index snapshot")
+    return data
+
+
+def _load_group(entries: List, file) -> Dict[str, Postings]:
+    group = {}
+    for key, kind, size in entries:
+        postings = Postings()
+        data = _read_section(file, size)
+        if kind == "ids":
+            postings.ids.frombytes(data)
+        else:
+            postings.bits = int.from_bytes(data, "little")
+        group[key] = postings
+    return group
+
+
+def save_index(index: QueryIndex):
+    """Write the index to query_index_file: a JSON header line, then raw id arrays.
+
+    Plain data rather than pickle, so a snapshot file can never run code.
+    """
+    if not query_index_file:
+        return
+    with index.lock:
+        sections = [_bits_to_bytes(index.universe)]
+        created_ids = array("q", (file_id for _, file_id in index.created))
+        sections.append(created_ids.tobytes())
+        sections.append("\n".join(created_at for created_at, _ in index.created).encode())
+        header = {
+            "version": SNAPSHOT_VERSION,
+            "byteorder": sys.byteorder,
+            "generations": index.generations,
+            "max_id": index.max_id,
+            "sections": [len(section) for section in sections],
+            "created": len(index.created),
+        }
+        for name in ("tags", "file_types", "months"):
+            header[name] = _dump_group(getattr(index, name), sections)
+    temp_path = f"{query_index_file}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(json.dumps(header).encode() + b"\n")
+        for section in sections:
+            file.write(section)
+    os.replace(temp_path, query_index_file)
+
+
+def read_index(generations: List[int]) -> QueryIndex | None:
+    """Return the snapshot in query_index_file if it matches `generations`."""
+    if not query_index_file:
+        return None
+    try:
+        with open(query_index_file, "rb") as file:
+            header = json.loads(file.readline())
+            # Checked before reading the rest, so a stale snapshot costs one line
+            if (
+                header.get("version") != SNAPSHOT_VERSION
+                or header.get("byteorder") != sys.byteorder
+                or header.get("generations") != generations
+            ):
+                return None
+            index = QueryIndex()
+            index.generations = header["generations"]
+            index.max_id = header["max_id"]
+            universe, created_ids, created_at = (
+                _read_section(file, size) for size in header["sections"]
+            )
+            index.universe = int.from_bytes(universe, "little")
+            ids = array("q")
+            ids.frombytes(created_ids)
+            dates = created_at.decode().split("\n") if header["created"] else []
+            if len(ids) != header["created"] or len(dates) != len(ids):
+                raise ValueError("inconsistent index snapshot")
+            index.created = list(zip(dates, ids))
+            for name in ("tags", "file_types", "months"):
+                setattr(index, name, _load_group(header[name], file))
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+    return index
+
+
+def _share(index: QueryIndex) -> QueryIndex:
+    # Called with _index_lock held
+    global _index
+    database.add_change_listener(index.apply)
+    _index = index
+    return index
+
+
+def load_index() -> QueryIndex:
+    """Return the shared index, warm-started from disk when it is still current.
+
+    For long-running processes (`un serve`): the index is built if needed.
+    """
+    with _index_lock:
+        if _index is not None:
+            return _index
+        index = read_index(database.get_generations())
+        if index is None:
+            index = QueryIndex()
+            index.build()
+            save_index(index)
+        return _share(index)
+
+
+def current_index() -> QueryIndex | None:
+    """Return the shared index if it has every write so far, else None.
+
+    A process that has not loaded the index only picks up a current snapshot.
+    A loaded index that missed writes by other processes is rebuilt in the
+    background, and None is returned until that is done.
+    """
+    generations = database.get_generations()
+    with _index_lock:
+        index = _index
+        if index is None:
+            index = read_index(generations)
+            if index is None:
+                return None
+            _share(index)
+    if index.generations != generations:
+        index.refresh_later()
+        return None
+    return index
+
+
+def filter_files(
+    expression: str = "",
+    file_types: List[str] | None = None,
+    date_after: str | None = None,
+    date_before: str | None = None,
+    limit: int | None = None,
+) -> List[Dict]:
+    """Files matching a tag expression, file types and a creation date range.
+
+    Answered from the index when it is current, otherwise by SQL: a full
+    rebuild costs far more than one query.
+    """
+    expression = to_expression(expression)
+    index = current_index()
+    if index is not None:
+        ids = index.query(expression, file_types, date_after, date_before)
+        return database.get_files_by_ids(ids[:limit])
+
+    tree = parse_expression(expression)
+    conditions, params = [], []
+    if tree is not None:
+        condition, params = _condition(tree)
+        conditions.append(condition)
+    if file_types:
+        conditions.append(f"f.file_type IN ({','.join('?' for _ in file_types)})")
+        params.extend(file_types)
+    if date_after:
+        conditions.append("f.created_at > ?")
+        params.append(date_after)
+    if date_before:
+        conditions.append("f.created_at < ?")
+        params.append(date_before)
+    return database.select_files(" AND ".join(conditions) or "1", params, limit)
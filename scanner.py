@@ -0,0 +1,165 @@
+import os
+import fnmatch
+from collections import Counter
+from functools import lru_cache
+from typing import Callable, Iterator, List, Tuple
+
+from config import ignore_patterns, max_file_size
+from extractor import EXTRACTORS
+import archives  # not `from archives import`: archives imports this module too
+
+SNIFF_SIZE = 512
+
+# Leading bytes of formats that never contain extractable text
+BINARY_SIGNATURES = [
+    (b"\x7fELF", "application/x-executable"),
+    (b"MZ", "application/x-msdownload"),
+    (b"\xcf\xfa\xed\xfe", "application/x-mach-binary"),
+    (b"\xce\xfa\xed\xfe", "application/x-mach-binary"),
+    (b"\xca\xfe\xba\xbe", "application/java-vm"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"\x00\x00\x01\x00", "image/x-icon"),
+    (b"RIFF", "audio/video (riff)"),
+    (b"\x1aE\xdf\xa3", "video/x-matroska"),
+    (b"ID3", "audio/mpeg"),
+    (b"OggS", "audio/ogg"),
+    (b"fLaC", "audio/flac"),
+    (b"PK\x03\x04", "application/zip"),
+    (b"\x1f\x8b", "application/gzip"),
+    (b"BZh", "application/x-bzip2"),
+    (b"\xfd7zXZ\x00", "application/x-xz"),
+    (b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+    (b"Rar!\x1a\x07", "application/vnd.rar"),
+    (b"wOFF", "font/woff"),
+    (b"wOF2", "font/woff2"),
+    (b"SQLite format 3\x00", "application/vnd.sqlite3"),
+    (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "application/x-ole-storage"),
+]
+
+TEXT_BOMS = (b"\xef\xbb\xbf", b"\xff\xfe", b"\xfe\xff")
+
+
+def sniff_mime(file_path: str) -> str | None:
+    """Return a MIME type if the file looks binary, None if it looks like text."""
+    with open(file_path, "rb") as file:
+        return sniff_head(file.read(SNIFF_SIZE))
+
+
+def sniff_head(head: bytes) -> str | None:
+    """Like sniff_mime, for the first SNIFF_SIZE bytes of a file."""
+    if head.startswith(TEXT_BOMS):
+        return None
+    if head[4:8] == b"ftyp":
+        return "video/mp4"
+    for signature, mime in BINARY_SIGNATURES:
+        if head.startswith(signature):
+            return mime
+    if b"\x00" in head:
+        return "application/octet-stream"
+    return None
+
+
+def _parse_patterns(patterns: List[str]) -> List[Tuple[str, bool, bool, bool]]:
+    # (pattern, negated, dir_only, anchored)
+    rules = []
+    for pattern in patterns:
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith("#"):
+            continue
+        negated = pattern.startswith("!")
+        if negated:
+            pattern = pattern[1:]
+        dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        anchored = "/" in pattern
+        rules.append((pattern.lstrip("/"), negated, dir_only, anchored))
+    return rules
+
+
+@lru_cache(maxsize=1)
+def default_rules():
+    return _parse_patterns(ignore_patterns)
+
+
+def is_ignored(rel_path: str, is_dir: bool, rules) -> bool:
+    """Match a root-relative path against gitignore-style rules (last match wins)."""
+    name = rel_path.rsplit("/", 1)[-1]
+    ignored = False
+    for pattern, negated, dir_only, anchored in rules:
+        if dir_only and not is_dir:
+            continue
+        target = rel_path if anchored else name
+        if fnmatch.fnmatchcase(target, pattern):
+            ignored = not negated
+    return ignored
+
+
+def _content_reason(name: str, size: int, sniff: Callable[[], str | None]) -> str | None:
+    if size == 0:
+        return "empty"
+    if max_file_size and size > max_file_size:
+        return "too large"
+
+    _, ext = os.path.splitext(name)
+    if ext.lower() in EXTRACTORS or archives.is_container(name):
+        return None
+    mime = sniff()
+    if mime is not None:
+        return f"binary ({mime})"
+    return None
+
+
+def check_file(file_path: str) -> str | None:
+    """Return the reason a file should be skipped, or None if it should be processed."""
+    try:
+        size = os.path.getsize(file_path)
+        return _content_reason(file_path, size, lambda: sniff_mime(file_path))
+    except OSError:
+        return "unreadable"
+
+
+def check_member(name: str, size: int, read_head: Callable[[], bytes]) -> str | None:
+    """Like check_file, for an archive member or attachment named relative to its container."""
+    parts = name.split("/")
+    for depth in range(1, len(parts)):
+        if is_ignored("/".join(parts[:depth]), True, default_rules()):
+            return "ignored directory"
+    if is_ignored(name, False, default_rules()):
+        return "ignored"
+    return _content_reason(name, size, lambda: sniff_head(read_head()))
+
+
+def scan_directory(directory: str, skipped: Counter | None = None) -> Iterator[str]:
+    """Yield files worth extracting, counting skipped files by reason in `skipped`."""
+    if skipped is None:
+        skipped = Counter()
+    rules = default_rules()
+
+    for root, dirs, files in os.walk(directory):
+        rel_root = os.path.relpath(root, directory).replace(os.sep, "/")
+        rel_root = "" if rel_root == "." else rel_root + "/"
+
+        # Prune ignored directories in place so os.walk never descends into them
+        kept = []
+        for d in dirs:
+            if is_ignored(rel_root + d, True, rules):
+                skipped["ignored directory"] += 1
+            else:
+                kept.append(d)
+        dirs[:] = kept
+
+        for file in files:
+            if is_ignored(rel_root + file, False, rules):
+                skipped["ignored"] += 1
+                continue
+            file_path = os.path.join(root, file)
+            reason = check_file(file_path)
+            if reason is not None:
+                skipped[reason] += 1
+                continue
+            yield file_path
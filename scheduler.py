@@ -0,0 +1,65 @@
+import os
+import re
+import time
+from collections import Counter
+from typing import Dict, List
+
+from config import schedule_order, pinned_directories
+
+# Age buckets in days, so that "small" can still order files within a bucket
+RECENCY_BUCKETS = (1, 7, 30, 365)
+SUMMARY_CHARS = 300
+WORD_PATTERN = re.compile(r"[^\W\d_]{4,}")
+
+
+def _pinned_rank(path: str) -> int:
+    for rank, directory in enumerate(pinned_directories):
+        directory = os.path.abspath(os.path.expanduser(directory))
+        if path == directory or path.startswith(directory + os.sep):
+            return rank
+    return len(pinned_directories)
+
+
+def _recency_bucket(mtime: float, now: float) -> int:
+    age_days = (now - mtime) / 86400
+    for bucket, limit in enumerate(RECENCY_BUCKETS):
+        if age_days < limit:
+            return bucket
+    return len(RECENCY_BUCKETS)
+
+
+def prioritize(paths: List[str]) -> List[str]:
+    """Order files by the keys in config.schedule_order, most urgent first."""
+    now = time.time()
+
+    def key(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return ()
+        keys = {
+            "pinned": lambda: _pinned_rank(path),
+            "recent": lambda: _recency_bucket(stat.st_mtime, now),
+            "small": lambda: stat.st_size,
+        }
+        return tuple(keys[name]() for name in schedule_order)
+
+    return sorted(paths, key=key)
+
+
+def heuristic_meta(path: str, text: str) -> Dict:
+    """Provisional metadata from the file name, its directories and the text itself."""
+    name = path.rsplit("/", 1)[-1]
+    stem, _, ext = name.rpartition(".")
+    title = re.sub(r"[_\-.]+", " ", stem or name).strip() or name
+
+    tags = [ext.lower()] if stem and ext else []
+    for part in path.split("/")[-3:-1]:
+        part = part.strip("!").lower()
+        if part and part not in tags:
+            tags.append(part)
+    words = Counter(word.lower() for word in WORD_PATTERN.findall(text[:20000]))
+    tags.extend(word for word, _ in words.most_common(10) if word not in tags)
+
+    summary = " ".join(text.split())[:SUMMARY_CHARS]
+    return {"title": title, "summary": summary, "tags": tags[:20]}
@@ -0,0 +1,247 @@
+import asyncio
+import json
+import os
+import socketserver
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from config import server_cache_size, query_index_file
+from database import (
+    use_persistent_connections,
+    search_files,
+    filter_by_tags,
+    list_files,
+    get_stats,
+    get_file_by_id,
+    get_all_tags,
+    get_tags_for_file,
+    get_generation,
+    compute_facets,
+    add_tag,
+    rename_tag,
+    split_id,
+)
+from ingest import ShardWriters, ingest
+from processor import METRICS
+from query_index import filter_files, is_tag_expression, load_index, save_index
+
+
+class QueryCache:
+    """LRU of recent read results plus the tag lists, dropped on every write."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.lock = threading.Lock()
+        self.queries = OrderedDict()
+        self.file_tags = {}
+        self.all_tags = None
+        self.generation = 0
+        self.library_generation = None
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.queries:
+                self.queries.move_to_end(key)
+                return self.queries[key]
+            generation = self.generation
+        value = compute()
+        with self.lock:
+            # A write landed while computing: the value may already be stale
+            if generation != self.generation:
+                return value
+            self.queries[key] = value
+            if len(self.queries) > self.size:
+                self.queries.popitem(last=False)
+        return value
+
+    def tags_for_file(self, file_id: int):
+        tags = self.file_tags.get(file_id)
+        if tags is None:
+            tags = get_tags_for_file(file_id)
+            self.file_tags[file_id] = tags
+        return tags
+
+    def tags(self):
+        if self.all_tags is None:
+            self.all_tags = get_all_tags()
+        return self.all_tags
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.queries.clear()
+            self.file_tags = {}
+            self.all_tags = None
+
+    def refresh(self):
+        # Writes by other processes, such as `un add`, only show in the database
+        generation = get_generation()
+        if generation != self.library_generation:
+            self.invalidate()
+            self.library_generation = generation
+
+
+cache = QueryCache(server_cache_size)
+# Readers run concurrently; every write, from /add or a tag edit, goes through these
+writers = ShardWriters()
+
+
+def with_facets(results, params, limit):
+    if "facets" not in params:
+        return results
+    # Fetched without the limit, so the facets count every match
+    return {"results": results[:limit], "facets": compute_facets(results)}
+
+
+def handle_get(path: str, params: dict):
+    def param(name, default=None):
+        return params.get(name, [default])[0]
+
+    cache.refresh()
+    limit = int(param("limit")) if param("limit") else None
+    fetch_limit = None if "facets" in params else limit
+
+    if path == "/search":
+        keywords = param("q", "")
+        results = cache.get(
+            ("search", keywords, fetch_limit), lambda: search_files(keywords, fetch_limit)
+        )
+        return with_facets(results, params, limit)
+    if path == "/filter":
+        raw = param("tags", "")
+        file_types = param("type")
+        date_after, date_before = param("after"), param("before")
+        key = ("filter", raw, file_types, date_after, date_before, fetch_limit)
+        # Without the index, only type, date and expression filters need filter_files,
+        # which then answers from SQL
+        if query_index_file or file_types or date_after or date_before or is_tag_expression(raw):
+            types = file_types.split(",") if file_types else None
+            results = cache.get(
+                key, lambda: filter_files(raw, types, date_after, date_before, fetch_limit)
+            )
+        else:
+            tags = raw.split(",") if raw else []
+            results = cache.get(key, lambda: filter_by_tags(tags, fetch_limit))
+        return with_facets(results, params, limit)
+    if path == "/list":
+        date_after = param("date_after")
+        return cache.get(
+            ("list", date_after, limit), lambda: list_files(date_after, limit)
+        )
+    if path == "/stats":
+        stat_type = {"type": "file_type", "tag": "tag"}.get(param("by"))
+        return cache.get(("stats", stat_type), lambda: get_stats(stat_type))
+    if path == "/tags":
+        return cache.tags()
+    if path == "/metrics":
+        return dict(METRICS)
+    if path.startswith("/files/"):
+        file_id = int(path[len("/files/"):])
+        file_info = get_file_by_id(file_id)
+        if file_info is None:
+            raise LookupError(f"No file found with ID {file_id}")
+        return dict(file_info, tags=cache.tags_for_file(file_id))
+    raise LookupError(f"Unknown endpoint {path}")
+
+
+def ingest_summary(result) -> dict:
+    summary = {
+        "path": result.path,
+        "status": result.status,
+        "file_id": result.file_id,
+        "error": result.error,
+    }
+    if result.extraction is not None:
+        summary["extraction"] = result.extraction.status
+    return summary
+
+
+def handle_post(path: str, body: dict):
+    try:
+        if path == "/add":
+            # Only the writes are queued on the shared writers, not the model calls.
+            # Each request runs its own event loop.
+            results = asyncio.run(ingest(body["path"], bool(body.get("triage")), writers))
+            return {"status": "ok", "results": [ingest_summary(r) for r in results]}
+        if path == "/tag":
+            file_id = int(body["file_id"])
+            shard, _ = split_id(file_id)
+            writers.submit(shard, add_tag, file_id, body["tag"]).result()
+        elif path == "/tag/rename":
+            # Renames touch every shard, so they wait for all shard writers
+            writers.exclusive(rename_tag, body["old_name"], body["new_name"])
+        else:
+            raise LookupError(f"Unknown endpoint {path}")
+    finally:
+        cache.invalidate()
+    return {"status": "ok"}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status: int, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def dispatch(self, handler, *args):
+        try:
+            self.send_json(200, handler(*args))
+        except (ValueError, KeyError) as e:
+            self.send_json(400, {"error": str(e)})
+        except LookupError as e:
+            self.send_json(404, {"error": str(e)})
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.dispatch(handle_get, url.path, parse_qs(url.query, keep_blank_values=True))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError as e:
+            self.send_json(400, {"error": f"Invalid JSON body: {e}"})
+            return
+        self.dispatch(handle_post, urlparse(self.path).path, body)
+
+    def log_message(self, format, *args):
+        # Per-request logging costs more than the queries themselves
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(host: str, port: int, socket_path: str | None = None):
+    use_persistent_connections()
+    if query_index_file:
+        index = load_index()
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, RequestHandler)
+        print(f"Serving on unix socket {socket_path}")
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+        print(f"Serving on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if query_index_file:
+            # Persist incremental updates for the next warm start
+            save_index(index)
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)